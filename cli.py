@@ -1,6 +1,9 @@
+import sys
+
 from meccg.repl import repl
 
+# pass a database file to skip loading the cards after the first run (delete it to reload them)
 repl('''
     LOAD JSONL FROM `var/jsonl/${source}.jsonl` AS card
     CREATE card;
-''')
+''', sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,57 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# use the fastest JSON decoder that is installed, they all take bytes
+if orjson is not None:
+    loads = orjson.loads
+elif msgspec is not None:
+    loads = msgspec.json.decode
+else:
+    loads = json.loads
+
+
+def decode_lines(lines):
+    """
+    Decodes a batch of JSON lines at once, by decoding them as a single array with an array for each line, so that a
+    line holds exactly one value if its array does
+    >>> decode_lines([b'{"name": "Ori"}\\n', b'\\n', b'[1, 2]\\n'])
+    [{'name': 'Ori'}, [1, 2]]
+    >>> try:
+    ...     decode_lines([b'[1\\n', b'2]\\n', b'3, 4\\n'])
+    ... except ValueError:
+    ...     print('Invalid')
+    Invalid
+    """
+    lines = [line for line in lines if not line.isspace()]
+    try:
+        values = loads(b'[[' + b'],['.join(lines) + b']]')
+        if len(values) == len(lines) and all(len(value) == 1 for value in values):
+            return [value[0] for value in values]
+    except Exception:
+        pass
+
+    # decode the lines one by one, so that an error is about the right line (or a line like 1, 2 fails)
+    return [loads(line) for line in lines]
+
+
+def read_batches(fp, size=1 << 20):
+    """
+    Reads a JSONL file (opened in binary mode) in chunks of about size bytes and yields lists of decoded values
+    >>> import io
+    >>> list(read_batches(io.BytesIO(b'"Ori"\\n"Dori"\\n"Nori"\\n'), size=8))
+    [['Ori', 'Dori'], ['Nori']]
+    """
+    while True:
+        lines = fp.readlines(size)
+        if len(lines) == 0:
+            break
+        yield decode_lines(lines)
@@ -0,0 +1,190 @@
+import json
+from array import array
+from collections.abc import MutableMapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def enc(v):
+    """
+    Encodes a JSON value into a dictionary key, telling apart values that are equal in Python, like 1 and true
+    >>> enc('Ori')
+    'Ori'
+    >>> enc(1) == enc(True)
+    False
+    >>> enc(['Sage'])
+    ('["Sage"]',)
+    """
+    return v if isinstance(v, str) else (json.dumps(v),)
+
+
+class Column:
+    """
+    The values of one attribute for each row, stored as codes into a dictionary of distinct values (-1 if absent)
+    >>> column = Column(1)
+    >>> column.append('Hero')
+    >>> column.append(None)
+    >>> column.append('Hero')
+    >>> list(column.codes), column.values
+    ([-1, 0, 1, 0], ['Hero', None])
+    >>> column.find('Hero'), column.find(1)
+    ([0], [])
+    """
+    def __init__(self, n=0):
+        self.codes = array('q', [-1]) * n
+        self.values = []
+        self._codes = {}
+
+    def encode(self, v):
+        k = enc(v)
+        if k not in self._codes:
+            self._codes[k] = len(self.values)
+            self.values.append(v)
+        return self._codes[k]
+
+    def append(self, v):
+        self.codes.append(self.encode(v))
+
+    def find(self, v):
+        """
+        Lists the codes of the values that are equal to a value
+        """
+        if isinstance(v, str):
+            return [self._codes[v]] if v in self._codes else []
+        else:
+            return [code for code, w in enumerate(self.values) if not isinstance(w, str) and w == v]
+
+
+class ColumnStore(MutableMapping):
+    """
+    A dictionary of records by id, which stores each top-level attribute of the records in a column, and the attributes
+    each record has (in order) as a shape, while records that aren't objects are kept as they are (with no shape)
+    >>> store = ColumnStore()
+    >>> store[1] = {'set': 'The Wizards', 'name': 'Ori', 'mp': 1}
+    >>> store[2] = {'name': 'Gandalf', 'set': 'The Wizards', 'skills': ['Sage']}
+    >>> store[3] = {'set': 'The Dragons', 'name': 'Ori', 'mp': True}
+    >>> store[2]
+    {'name': 'Gandalf', 'set': 'The Wizards', 'skills': ['Sage']}
+    >>> store.select({'name': 'Ori'})
+    [1, 3]
+    >>> store.select({'set': 'The Wizards', 'mp': 1})
+    [1]
+    >>> store.select({'name': 'Dori'})
+    []
+    >>> store[1] = {'set': 'The Wizards', 'name': 'Ori', 'mp': 2}
+    >>> del store[3]
+    >>> list(store), store[1]
+    ([1, 2], {'set': 'The Wizards', 'name': 'Ori', 'mp': 2})
+    >>> store.select({'mp': 2})
+    [1]
+    >>> store[4] = 'settings'
+    >>> store[5] = ['set']
+    >>> store[4], store[5], store.select({'set': 'The Wizards'})
+    ('settings', ['set'], [1, 2])
+    >>> store[4] = {'set': 'The Wizards'}
+    >>> del store[5]
+    >>> list(store.items())[2:]
+    [(4, {'set': 'The Wizards'})]
+    """
+    def __init__(self):
+        self._rows = {}
+        self._ids = array('q')
+        self._shapes = Column()
+        self._columns = {}
+        self._others = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        return (i for i in self._ids if i != -1)
+
+    def __contains__(self, i):
+        return i in self._rows
+
+    def __getitem__(self, i):
+        row = self._rows[i]
+        shape = self._shapes.values[self._shapes.codes[row]]
+        if shape is None:
+            return self._others[i]
+        return {
+            k: column.values[column.codes[row]]
+            for k in shape
+            for column in [self._columns[k]]
+        }
+
+    def __setitem__(self, i, record):
+        if isinstance(record, dict):
+            shape = tuple(record)
+            self._others.pop(i, None)
+        else:
+            shape = None
+            self._others[i] = record
+            record = {}
+
+        for k in record:
+            if k not in self._columns:
+                self._columns[k] = Column(len(self._ids))
+
+        if i in self._rows:
+            # overwriting a record keeps its position, like in a dict
+            row = self._rows[i]
+            self._shapes.codes[row] = self._shapes.encode(shape)
+            for k, column in self._columns.items():
+                column.codes[row] = column.encode(record[k]) if k in record else -1
+        else:
+            self._rows[i] = len(self._ids)
+            self._ids.append(i)
+            self._shapes.append(shape)
+            for k, column in self._columns.items():
+                column.codes.append(column.encode(record[k]) if k in record else -1)
+
+    def __delitem__(self, i):
+        row = self._rows.pop(i)
+        self._others.pop(i, None)
+        self._ids[row] = -1
+        self._shapes.codes[row] = -1
+        for column in self._columns.values():
+            column.codes[row] = -1
+
+        if len(self._ids) > 2 * len(self._rows) + 1024:
+            self._compact()
+
+    def _compact(self):
+        # drop the rows of deleted records (but keep the dictionaries, so that the codes stay the same)
+        rows = [row for row, i in enumerate(self._ids) if i != -1]
+        self._ids = array('q', (self._ids[row] for row in rows))
+        self._shapes.codes = array('q', (self._shapes.codes[row] for row in rows))
+        for column in self._columns.values():
+            column.codes = array('q', (column.codes[row] for row in rows))
+        self._rows = {i: row for row, i in enumerate(self._ids)}
+
+    def select(self, eq):
+        """
+        Lists the ids of the records whose attributes are equal to the given values, in order
+        """
+        if len(self._ids) == 0:
+            return []
+
+        selections = []
+        for k, v in eq.items():
+            codes = self._columns[k].find(v) if k in self._columns else []
+            if len(codes) == 0:
+                return []
+            selections.append((self._columns[k], codes))
+
+        if numpy is not None:
+            mask = numpy.ones(len(self._ids), dtype=bool)
+            for column, codes in selections:
+                column_codes = numpy.frombuffer(column.codes, dtype=numpy.int64)
+                mask &= column_codes == codes[0] if len(codes) == 1 else numpy.isin(column_codes, codes)
+            return numpy.frombuffer(self._ids, dtype=numpy.int64)[mask].tolist()
+
+        rows = range(len(self._ids))
+        for column, codes in selections:
+            codes = set(codes)
+            rows = [row for row in rows if column.codes[row] in codes]
+        return [self._ids[row] for row in rows]
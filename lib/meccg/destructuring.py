@@ -15,6 +15,22 @@ def lit(v):
     return lambda x: [{}] if x == v else []
 
 
+def ref(f):
+    """
+    Match a value against a value that is only known when matching, like a query parameter
+    >>> parameters = {'name': 'foo'}
+    >>> e = ref(lambda: parameters['name'])
+    >>> e('bar')
+    []
+    >>> e('foo')
+    [{}]
+    >>> parameters['name'] = 'bar'
+    >>> e('bar')
+    [{}]
+    """
+    return lambda x: [{}] if x == f() else []
+
+
 def var(k):
     """
     Match a value into a variable k
@@ -1,4 +1,4 @@
-import itertools
+from meccg import indexing
 
 
 def var(k):
@@ -59,16 +59,87 @@ def grp_key(i):
     return lambda gc: gc['$keys'][i]
 
 
-def grp_arr(e):
-    return lambda gc: [
-        e(c)
-        for c in gc['$records']
-    ]
+def grp_agg(i):
+    return lambda gc: gc['$aggregates'][i]
 
 
-def grp_ret(ke, ge):
-    return lambda rs: (
-        (ge(r), r)
-        for gk, grs in itertools.groupby(rs, ke)
-        for r in [{'$keys': gk, '$records': list(grs)}]
-    )
+def agg_collect(e):
+    """
+    Aggregates the values of an expression into an array, as (initial state, step, final value) functions
+    """
+    def step(s, c):
+        s.append(e(c))
+        return s
+
+    return list, step, lambda s: s
+
+
+def agg_distinct(e, key):
+    """
+    Aggregates the distinct values of an expression into an array, telling values apart by a key like DISTINCT does
+    """
+    def step(s, c):
+        v = e(c)
+        k = key(v)
+        if k not in s[0]:
+            s[0].add(k)
+            s[1].append(v)
+        return s
+
+    return lambda: (set(), []), step, lambda s: s[1]
+
+
+def agg_count(e):
+    return lambda: 0, lambda s, c: s + 1 if e(c) is not None else s, lambda s: s
+
+
+def agg_sum(e):
+    def step(s, c):
+        v = e(c)
+        return s if v is None else s + v
+
+    return lambda: 0, step, lambda s: s
+
+
+def agg_min(e):
+    # keep the first of equal values, comparing them like ORDER BY does
+    def step(s, c):
+        v = e(c)
+        return s if v is None or s is not None and indexing.col(s) <= indexing.col(v) else v
+
+    return lambda: None, step, lambda s: s
+
+
+def agg_max(e):
+    def step(s, c):
+        v = e(c)
+        return s if v is None or s is not None and indexing.col(s) >= indexing.col(v) else v
+
+    return lambda: None, step, lambda s: s
+
+
+def grp_ret(ke, ags, ge):
+    """
+    Groups contexts by their keys in a hash table, updating the state of each aggregator per context, and returns the
+    grouped expression for each group, in the order in which the keys first appeared
+    >>> rs = [{'set': 'TW', 'name': 'Ori'}, {'set': 'TD', 'name': 'Smaug'}, {'set': 'TW', 'name': 'Dori'}]
+    >>> run = grp_ret(el(var('set')), [agg_collect(var('name')), agg_count(var('name'))], star())
+    >>> [gc for v, gc in run(rs)]
+    [{'$keys': ['TW'], '$aggregates': [['Ori', 'Dori'], 2]}, {'$keys': ['TD'], '$aggregates': [['Smaug'], 1]}]
+    """
+    def run(rs):
+        groups = {}
+        for r in rs:
+            gk = ke(r)
+            k = indexing.frz(gk)
+            if k not in groups:
+                groups[k] = gk, [init() for init, step, final in ags]
+            states = groups[k][1]
+            for j, (init, step, final) in enumerate(ags):
+                states[j] = step(states[j], r)
+
+        for gk, states in groups.values():
+            gc = {'$keys': gk, '$aggregates': [final(s) for (init, step, final), s in zip(ags, states)]}
+            yield ge(gc), gc
+
+    return run
@@ -0,0 +1,475 @@
+import hashlib
+from array import array
+from bisect import bisect_left, insort
+
+
+def frz(v):
+    """
+    Freezes a JSON value into a hashable key, turning objects into frozen sets and arrays into tuples
+    >>> frz('Ori')
+    'Ori'
+    >>> frz(['Warrior', 'Sage'])
+    ('Warrior', 'Sage')
+    >>> frz({'set': 'The Wizards', 'name': 'Ori'}) == frz({'name': 'Ori', 'set': 'The Wizards'})
+    True
+    >>> frz({'skills': ['Warrior']}) == frz([['skills', ['Warrior']]])
+    False
+    """
+    if isinstance(v, dict):
+        return frozenset((k, frz(w)) for k, w in v.items())
+    elif isinstance(v, list):
+        return tuple(frz(w) for w in v)
+    else:
+        return v
+
+
+def can(v):
+    """
+    Creates a canonical (hashable) form of a JSON value, which is only equal for values that are equal as JSON, so
+    unlike with frz, 1, 1.0 and true are different values (but the order of keys in an object still doesn't matter)
+    >>> can({'name': 'Ori', 'mp': 1}) == can({'mp': 1, 'name': 'Ori'})
+    True
+    >>> len({can(1), can(1.0), can(True), can([1]), can('1')})
+    5
+    """
+    if isinstance(v, dict):
+        return frozenset((k, can(w)) for k, w in v.items())
+    elif isinstance(v, list):
+        return tuple(can(w) for w in v)
+    elif isinstance(v, (bool, float)):
+        return type(v), v
+    else:
+        return v
+
+
+def fgp(v, h=None):
+    """
+    Computes a 128-bit fingerprint of a JSON value, which is equal for values with the same canonical form
+    >>> fgp({'name': 'Ori', 'skills': ['Warrior']}) == fgp({'skills': ['Warrior'], 'name': 'Ori'})
+    True
+    >>> len({fgp(1), fgp(1.0), fgp(True), fgp([1]), fgp('1'), fgp(['1']), fgp([[]]), fgp([[], []])})
+    8
+    """
+    if h is None:
+        h = hashlib.blake2b(digest_size=16)
+        fgp(v, h)
+        return h.digest()
+
+    if isinstance(v, dict):
+        h.update(b'{%d:' % len(v))
+        for k in sorted(v):
+            fgp(k, h)
+            fgp(v[k], h)
+    elif isinstance(v, list):
+        h.update(b'[%d:' % len(v))
+        for w in v:
+            fgp(w, h)
+    elif isinstance(v, str):
+        b = v.encode('utf-8')
+        h.update(b's%d:' % len(b))
+        h.update(b)
+    elif isinstance(v, bool):
+        h.update(b't' if v else b'f')
+    elif isinstance(v, int):
+        h.update(b'i%d;' % v)
+    elif isinstance(v, float):
+        h.update(b'd%s;' % repr(v).encode())
+    elif v is None:
+        h.update(b'n')
+    else:
+        raise Exception(f'Value {v!r} can not be fingerprinted')
+
+
+def thaw(k):
+    """
+    Turns a frozen key back into a JSON value
+    >>> thaw(frz({'name': 'Ori', 'skills': ['Warrior']}))
+    {'name': 'Ori', 'skills': ['Warrior']}
+    >>> frz(thaw(frz([['skills', ['Warrior']]]))) == frz([['skills', ['Warrior']]])
+    True
+    """
+    if isinstance(k, frozenset):
+        return {w: thaw(v) for w, v in sorted(k)}
+    elif isinstance(k, tuple):
+        return [thaw(v) for v in k]
+    else:
+        return k
+
+
+def tpl(v):
+    """
+    Turns the arrays in a JSON value back into tuples, like the collation keys that were saved as JSON
+    >>> tpl([[3, 'Ori'], [4, [[2, 1]]]])
+    ((3, 'Ori'), (4, ((2, 1),)))
+    """
+    return tuple(tpl(w) for w in v) if isinstance(v, list) else v
+
+
+# sorts after the collation key of any value
+END = 9,
+
+
+def col(v):
+    """
+    Creates a collation key for a JSON value, ordering null, booleans, numbers, strings, arrays and objects
+    >>> sorted(['10', 9, None, '9', 10, [1], {'a': 1}, True], key=col)
+    [None, True, 9, 10, '10', '9', [1], {'a': 1}]
+    """
+    if v is None:
+        return 0,
+    elif isinstance(v, bool):
+        return 1, v
+    elif isinstance(v, (int, float)):
+        return 2, v
+    elif isinstance(v, str):
+        return 3, v
+    elif isinstance(v, list):
+        return 4, tuple(col(w) for w in v)
+    elif isinstance(v, dict):
+        return 5, tuple(sorted((k, col(w)) for k, w in v.items()))
+    else:
+        raise Exception(f'Value {v!r} can not be collated')
+
+
+def exact(v):
+    """
+    Checks if the values that are equal to a value all have its collation key, which isn't the case for booleans and the
+    numbers that are equal to them (1 == 1.0 == true)
+    >>> exact('Ori'), exact([2, None]), exact(1.0), exact({'mp': True})
+    (True, True, False, False)
+    """
+    if isinstance(v, bool):
+        return False
+    elif isinstance(v, (int, float)):
+        return v != 0 and v != 1
+    elif isinstance(v, list):
+        return all(exact(w) for w in v)
+    elif isinstance(v, dict):
+        return all(exact(w) for w in v.values())
+    else:
+        return True
+
+
+def has(p, i):
+    """
+    Checks if a sorted posting array contains a record id
+    >>> has(array('q', [1, 3, 5]), 3)
+    True
+    >>> has(array('q', [1, 3, 5]), 4)
+    False
+    """
+    j = bisect_left(p, i)
+    return j < len(p) and p[j] == i
+
+
+def ins(p, i):
+    """
+    Inserts a record id into a sorted posting array
+    >>> p = array('q', [1, 5])
+    >>> ins(p, 7)
+    >>> ins(p, 3)
+    >>> ins(p, 3)
+    >>> list(p)
+    [1, 3, 5, 7]
+    """
+    if len(p) == 0 or p[-1] < i:
+        p.append(i)
+    else:
+        j = bisect_left(p, i)
+        if j == len(p) or p[j] != i:
+            p.insert(j, i)
+
+
+def dsc(p, i):
+    """
+    Discards a record id from a sorted posting array
+    >>> p = array('q', [1, 3, 5])
+    >>> dsc(p, 3)
+    >>> dsc(p, 4)
+    >>> list(p)
+    [1, 5]
+    """
+    j = bisect_left(p, i)
+    if j < len(p) and p[j] == i:
+        del p[j]
+
+
+def isect(ps):
+    """
+    Intersects sorted posting arrays, probing the larger ones for each id in the smallest one
+    >>> isect([array('q', [1, 2, 3, 5, 8]), array('q', [2, 3, 5, 7]), array('q', [1, 3, 5])])
+    [3, 5]
+    >>> isect([array('q', [1, 2])])
+    [1, 2]
+    """
+    ps = sorted(ps, key=len)
+
+    return [
+        i
+        for i in ps[0]
+        if all(has(p, i) for p in ps[1:])
+    ]
+
+
+class HashIndex:
+    """
+    An index from frozen keys to sorted arrays of record ids
+    >>> index = HashIndex()
+    >>> index.add(2, {'set': 'The Wizards', 'name': 'Ori'})
+    >>> index.add(1, {'set': 'The Wizards', 'name': 'Ori'})
+    >>> index.add(3, {'set': 'The Dragons', 'name': 'Ori'})
+    >>> list(index.get({'name': 'Ori', 'set': 'The Wizards'}))
+    [1, 2]
+    >>> index.remove(1, {'set': 'The Wizards', 'name': 'Ori'})
+    >>> list(index.get({'set': 'The Wizards', 'name': 'Ori'}))
+    [2]
+    >>> index.remove(3, {'set': 'The Dragons', 'name': 'Ori'})
+    >>> len(index)
+    1
+    """
+    def __init__(self):
+        self._postings = {}
+
+    def __len__(self):
+        return len(self._postings)
+
+    def add(self, i, key):
+        k = frz(key)
+        if k not in self._postings:
+            self._postings[k] = array('q')
+        ins(self._postings[k], i)
+
+    def remove(self, i, key):
+        k = frz(key)
+        if k in self._postings:
+            dsc(self._postings[k], i)
+            if len(self._postings[k]) == 0:
+                del self._postings[k]
+
+    def get(self, key):
+        return self._postings.get(frz(key), ())
+
+    def dump(self):
+        """
+        Lists the postings as JSON
+        >>> index = HashIndex()
+        >>> index.add(1, {'name': 'Ori'})
+        >>> index.dump()
+        [[{'name': 'Ori'}, [1]]]
+        >>> copy = HashIndex()
+        >>> copy.load(index.dump())
+        >>> list(copy.get({'name': 'Ori'}))
+        [1]
+        """
+        return [[thaw(k), list(p)] for k, p in self._postings.items()]
+
+    def load(self, postings):
+        self._postings = {frz(key): array('q', ids) for key, ids in postings}
+
+
+class SortedIndex:
+    """
+    An index that keeps record ids sorted by the collation keys of one or more variables
+    >>> index = SortedIndex(['set', 'name'])
+    >>> index.add(1, {'set': 'The Wizards', 'name': 'Ori'})
+    >>> index.add(2, {'set': 'The Wizards', 'name': 'Gandalf'})
+    >>> index.add(3, {'set': 'The Wizards', 'name': 'Glorfindel II'})
+    >>> index.add(4, {'set': 'The Dragons', 'name': 'Gandalf'})
+    >>> index.scan([])
+    [4, 2, 3, 1]
+    >>> index.scan(['The Wizards'])
+    [2, 3, 1]
+    >>> index.scan(['The Wizards'], prefix='G')
+    [2, 3]
+    >>> index.scan(['The Wizards'], lo=('Glorfindel II', False))
+    [1]
+    >>> index.scan(['The Wizards'], lo=('Gandalf', True), hi=('Ori', False))
+    [2, 3]
+    >>> index.count(['The Wizards']), index.count(['The Wizards'], prefix='G'), index.count([], hi=('The Dragons', True))
+    (3, 2, 1)
+    >>> index.remove(2, {'set': 'The Wizards', 'name': 'Gandalf'})
+    >>> index.scan(['The Wizards', 'Gandalf'])
+    []
+    >>> index.add(5, {'set': 'The Wizards'})
+    >>> index.scan(['The Wizards'])
+    [5, 3, 1]
+    """
+    def __init__(self, variables):
+        self.variables = variables
+        self._entries = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, key):
+        # records without some of the variables are kept as well (before all values), so that a scan on the variables
+        # a pattern does have finds every record that might match it
+        return tuple(col(key[k]) if k in key else (-1,) for k in self.variables)
+
+    def add(self, i, key):
+        insort(self._entries, (self._key(key), i))
+
+    def dump(self):
+        return [list(entry) for entry in self._entries]
+
+    def load(self, entries):
+        self._entries = [tpl(entry) for entry in entries]
+
+    def remove(self, i, key):
+        entry = (self._key(key), i)
+        j = bisect_left(self._entries, entry)
+        if j < len(self._entries) and self._entries[j] == entry:
+            del self._entries[j]
+
+    def count(self, eq, lo=None, hi=None, prefix=None):
+        """
+        Counts the entries in the range that a scan goes through, without going through them
+        """
+        start = tuple(col(v) for v in eq)
+        if prefix is not None:
+            lo_key, hi_key = start + (col(prefix),), start + ((3, prefix + '\U0010ffff'),)
+        else:
+            lo_key = start + (col(lo[0]),) if lo is not None else start
+            hi_key = start + (col(hi[0]), END) if hi is not None else start + (END,)
+
+        return max(0, bisect_left(self._entries, (hi_key,)) - bisect_left(self._entries, (lo_key,)))
+
+    def scan(self, eq, lo=None, hi=None, prefix=None):
+        """
+        Lists record ids in key order, for keys that start with the values in eq and where the next value is
+        between the bounds lo and hi (pairs of a value and whether it is inclusive) or starts with a string prefix
+        """
+        n = len(eq)
+        start = tuple(col(v) for v in eq)
+        if prefix is not None:
+            start += (col(prefix),)
+        elif lo is not None:
+            start += (col(lo[0]),)
+        lo_key = col(lo[0]) if lo is not None else None
+        hi_key = col(hi[0]) if hi is not None else None
+
+        result = []
+        for j in range(bisect_left(self._entries, (start,)), len(self._entries)):
+            key, i = self._entries[j]
+            if key[:n] != start[:n]:
+                break
+            if prefix is not None:
+                if key[n][0] != 3 or not key[n][1].startswith(prefix):
+                    break
+            if lo is not None and not lo[1] and key[n] == lo_key:
+                continue
+            if hi is not None and (key[n] > hi_key or not hi[1] and key[n] == hi_key):
+                break
+            result.append(i)
+        return result
+
+
+def grams(s, n=3):
+    """
+    Lists the n-grams of a string
+    >>> sorted(grams('Orcs.'))
+    ['Orc', 'cs.', 'rcs']
+    >>> grams('Or')
+    set()
+    """
+    return {s[j:j + n] for j in range(len(s) - n + 1)}
+
+
+def lit(pattern):
+    """
+    Extracts the literal text that a string matching a regular expression must start with (after the optional ^)
+    >>> lit('^Dwarves\\\\. Five strikes\\\\.$')
+    'Dwarves. Five strikes.'
+    >>> lit('^Orcs?\\\\.$')
+    'Orc'
+    >>> lit('^(Orcs|Trolls)\\\\.$')
+    ''
+    >>> lit('^Orcs|Trolls$')
+    ''
+    """
+    if '|' in pattern:
+        return ''
+
+    literal = ''
+    j = 1 if pattern.startswith('^') else 0
+    while j < len(pattern):
+        c = pattern[j]
+        if c == '\\' and j + 1 < len(pattern) and not pattern[j + 1].isalnum():
+            c = pattern[j + 1]
+            j += 2
+        elif c in '.^$*+?{}[]()\\':
+            break
+        else:
+            j += 1
+
+        if j < len(pattern) and pattern[j] in '*?{':
+            break
+        literal += c
+
+    return literal
+
+
+class TextIndex:
+    """
+    An inverted index from the trigrams of strings (or strings in arrays) to record ids
+    >>> index = TextIndex(['class', 'text'])
+    >>> index.add(1, {'class': 'Creature', 'text': ['Orcs.', 'Four strikes.']})
+    >>> index.add(2, {'class': 'Short-event', 'text': ['Playable on an Orc.']})
+    >>> index.search('text', 'Orc')
+    [1, 2]
+    >>> index.search('text', 'Orcs.')
+    [1]
+    >>> index.search('class', 'event')
+    [2]
+    >>> index.search('class', 'ev') is None
+    True
+    >>> index.add(3, {'text': ['Orcs.']})
+    >>> index.search('text', 'Orcs.')
+    [1, 3]
+    >>> index.remove(1, {'class': 'Creature', 'text': ['Orcs.', 'Four strikes.']})
+    >>> index.search('text', 'Orc')
+    [2, 3]
+    """
+    def __init__(self, variables):
+        self.variables = variables
+        self._postings = HashIndex()
+
+    def __len__(self):
+        return len(self._postings)
+
+    def _keys(self, key):
+        # every variable is indexed on its own, so records that only have some of them are found as well
+        for k in self.variables:
+            value = key.get(k)
+            for s in [value] if isinstance(value, str) else value if isinstance(value, list) else []:
+                if isinstance(s, str):
+                    yield from ((k, g) for g in grams(s))
+
+    def add(self, i, key):
+        for k in set(self._keys(key)):
+            self._postings.add(i, k)
+
+    def remove(self, i, key):
+        for k in set(self._keys(key)):
+            self._postings.remove(i, k)
+
+    def dump(self):
+        return self._postings.dump()
+
+    def load(self, postings):
+        self._postings.load(postings)
+
+    def postings(self, variable, text):
+        """
+        Lists the postings of the trigrams of the text, which each hold every record id that might contain it
+        """
+        return [self._postings.get((variable, g)) for g in grams(text)]
+
+    def search(self, variable, text):
+        """
+        Lists record ids that might contain the text, or None if the text is too short to use the index
+        """
+        if len(grams(text)) == 0:
+            return None
+
+        return isect(self.postings(variable, text))
@@ -5,6 +5,8 @@ from glob import glob
 
 from bs4 import BeautifulSoup, NavigableString
 
+from meccg import codec
+
 
 def load_jsonl(html_filename, lines_to_attributes, card_tag_name):
     jsonl_filename = html_filename.replace('html', 'jsonl')
@@ -159,9 +161,9 @@ def load_whcharacters(html_filename):
 
 
 def read_jsonl(filename):
-    with open(filename) as fp:
-        for line in fp:
-            yield json.loads(line)
+    with open(filename, 'rb') as fp:
+        for batch in codec.read_batches(fp):
+            yield from batch
 
 
 def read_all_jsonl():
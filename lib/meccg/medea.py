@@ -1,12 +1,26 @@
+import collections
+import contextvars
 import glob
 import itertools
 import json
+import os
 import re
+import threading
 
 import jsonschema
 from lark import Lark, Tree, Token
 
-from meccg import destructuring, sat, expr
+from meccg import destructuring, sat, expr, indexing, patterns, parallel, columnar, storage, codec, output, sorting
+
+# marks a value that a pattern can't look up in a given context
+missing = object()
+
+# the $parameters of the query that is running, which are set in a context of its own for each call of query, so
+# that the lazy results of different calls each keep their own parameters
+bound_parameters = contextvars.ContextVar('parameters')
+
+# files that are larger than this are streamed instead of being kept in the file cache
+cached_file_size = 1 << 24
 
 parser = Lark(r"""
     script: (statement ";")*
@@ -16,6 +30,8 @@ parser = Lark(r"""
               | drop_index_statement
     
     create_index_statement: "CREATE" "INDEX" CNAME "ON" target_expression
+                          | "CREATE" "INDEX" CNAME "ON" target_expression "USING" "SORTED" -> create_sorted_index_statement
+                          | "CREATE" "TEXT" "INDEX" CNAME "ON" target_expression -> create_text_index_statement
 
     drop_index_statement: "DROP" "INDEX" CNAME
 
@@ -33,14 +49,20 @@ parser = Lark(r"""
                 | set_clause
                 | where_clause
                 | order_by_clause
+                | skip_clause
+                | limit_clause
 
     load_clause: "LOAD" FORMAT "FROM" target_expression "AS" target_expression
+               | "LOAD" "UNORDERED" FORMAT "FROM" target_expression "AS" target_expression -> load_unordered_clause
     match_clause: "MATCH" target_expression
     with_clause: "WITH" with_pair ("," with_pair)*
+               | "WITH" "DISTINCT" with_pair ("," with_pair)* -> with_distinct_clause
     set_clause: "SET" target_variable "=" source_expression
               | "SET" target_global "=" source_expression
     where_clause: "WHERE" source_expression
     order_by_clause: "ORDER" "BY" source_expression
+    skip_clause: "SKIP" INT
+    limit_clause: "LIMIT" INT
 
     ?with_pair: with_shorthand_pair
               | with_full_pair
@@ -65,6 +87,7 @@ parser = Lark(r"""
     save_clause: "SAVE" FORMAT source_expression "TO" source_expression
     
     ?target_expression: target_constant
+                      | target_parameter
                       | target_template
                       | target_variable
                       | target_object
@@ -92,6 +115,8 @@ parser = Lark(r"""
                    | target_variable "." CNAME
 
     target_global: GLOBAL
+
+    target_parameter: PARAMETER
     
     target_constant: ESCAPED_STRING
                    | SIGNED_NUMBER
@@ -118,8 +143,13 @@ parser = Lark(r"""
     ?compare_expression: add_expression
                        | compare_expression "==" prefix_expression -> source_eq
                        | compare_expression "!=" prefix_expression -> source_ne
+                       | compare_expression "<" prefix_expression -> source_lt
+                       | compare_expression "<=" prefix_expression -> source_le
+                       | compare_expression ">" prefix_expression -> source_gt
+                       | compare_expression ">=" prefix_expression -> source_ge
                        | compare_expression "IS" FORMAT "(" source_expression ")" -> source_valid
                        | compare_expression "IS" "NOT" FORMAT "(" source_expression ")" -> source_invalid
+                       | compare_expression "MATCHES" "ANY" prefix_expression -> source_matches_any
 
     ?add_expression: prefix_expression
                    | add_expression "+" prefix_expression -> source_add
@@ -134,6 +164,8 @@ parser = Lark(r"""
                       | member_expression "." CNAME source_method_arguments -> source_method_call
                       | member_expression "." CNAME -> source_property
                       | member_expression "[" "]" -> source_aggregate
+                      | AGGREGATE "(" source_expression ")" -> source_aggregate_function
+                      | "COLLECT" "(" "DISTINCT" source_expression ")" -> source_aggregate_distinct
                       | member_expression "[" source_expression "]" -> source_element
 
     case_expression: "CASE" case_expression_case* case_expression_else? "END" -> source_boolean_case
@@ -148,6 +180,7 @@ parser = Lark(r"""
     ?terminal_expression: source_constant
                         | source_variable
                         | source_global
+                        | source_parameter
                         | source_star
                         | source_object
                         | source_array
@@ -162,6 +195,8 @@ parser = Lark(r"""
 
     source_global: GLOBAL
 
+    source_parameter: PARAMETER
+
     source_star: "*"
 
     source_object: "{" "}"
@@ -185,15 +220,24 @@ parser = Lark(r"""
 
     GLOBAL: "@"? ("_"|LETTER) ("_"|LETTER|DIGIT)*
 
+    PARAMETER: "$" ("_"|LETTER) ("_"|LETTER|DIGIT)*
+
     FORMAT: "JSONL"
           | "JSON"
           | "TEXT"
 
+    AGGREGATE: "COUNT"
+             | "SUM"
+             | "MIN"
+             | "MAX"
+             | "COLLECT"
+
     INLINE_COMMENT: /--.*/
     MULTILINE_COMMENT: "/*" /(.|\n|\r)*?/ "*/"
 
     %import common.ESCAPED_STRING
     %import common.SIGNED_NUMBER
+    %import common.INT
     %import common.CNAME
     %import common.LETTER
     %import common.DIGIT
@@ -205,88 +249,392 @@ parser = Lark(r"""
 
 
 class Session:
-    def __init__(self):
-        self._records = []
+    def __init__(
+            self, plan_cache_size=128, pattern_cache_size=64, regex_cache_size=1024, workers=None, partition_size=4096,
+            storage='dict', io_workers=8, file_cache_size=1 << 28, sort_budget=1000000,
+            distinct_fingerprints=False
+    ):
+        self._plans = collections.OrderedDict()
+        self._plan_cache_size = plan_cache_size
+        self._pattern_sets = collections.OrderedDict()
+        self._pattern_cache_size = pattern_cache_size
+        self._regexes = collections.OrderedDict()
+        self._regex_cache_size = regex_cache_size
+        # with more than one worker, read-only UNION branches and partitions of large MATCHes run in forked processes
+        self._workers = workers if workers is not None and workers > 1 and parallel.available() else None
+        self._partition_size = partition_size
+        self._io_workers = io_workers
+        # decoded files are kept in an LRU cache (of at most file_cache_size bytes of files) that checks their
+        # modification time, except for the files the current statement already read, which are only kept for the
+        # statement as long as they are in the cache, both are shared by the threads that read files
+        self._statement_files = {}
+        self._file_cache = collections.OrderedDict()
+        self._file_cache_size = file_cache_size
+        self._file_cache_used = 0
+        self._file_lock = threading.Lock()
+        # ORDER BY spills sorted runs of this many rows to temporary files
+        self._sort_budget = sort_budget
+        # DISTINCT keeps a canonical form of each value, or only a 128-bit fingerprint of it to save memory
+        self._distinct_key = indexing.fgp if distinct_fingerprints else indexing.can
+        # records are kept in a dict by id, or in columns of their top-level attributes
+        if storage == 'dict':
+            self._records = {}
+        elif storage == 'columnar':
+            self._records = columnar.ColumnStore()
+        else:
+            raise Exception(f'Storage {storage} not supported')
+        self._next_id = 0
+        self._version = 0
         self._globals = {}
         self._index_keys = {}
+        self._index_compiled_keys = {}
         self._index_records = {}
 
-    def query(self, query_string):
-        query_tree = parser.parse(query_string)
-        return self._eval(query_tree, None)
+    @classmethod
+    def open(cls, path, **options):
+        # records are decoded from the (memory-mapped) file when they're first used, unless they're kept in columns
+        session = cls(**options)
+        header, records = storage.read(path)
+        if isinstance(session._records, columnar.ColumnStore):
+            for i, record in records.items():
+                session._records[i] = record
+            records.close()
+        else:
+            session._records = records
+
+        session._next_id = header['next_id']
+        session._globals = header['globals']
+        for index in header['indexes']:
+            session._create_index(index['name'], storage.load_tree(index['key']), index['type'], index['postings'])
+
+        return session
+
+    def save(self, path):
+        storage.write(path, self._records, {
+            'next_id': self._next_id,
+            'globals': self._globals,
+            'indexes': [
+                {
+                    'name': name,
+                    'type': (
+                        'SORTED' if isinstance(index, indexing.SortedIndex)
+                        else 'TEXT' if isinstance(index, indexing.TextIndex)
+                        else 'HASH'
+                    ),
+                    'key': storage.dump_tree(self._index_keys[name]),
+                    'postings': index.dump(),
+                }
+                for name, index in self._index_records.items()
+            ],
+        })
+
+    def close(self):
+        # closes the database file the session was opened from, if records are still read from it
+        if isinstance(self._records, storage.LazyStore):
+            self._records.close()
+
+    def query(self, query_string, **parameters):
+        # parsing and compiling only depends on the query string, so compiled queries are kept in an LRU cache
+        if query_string in self._plans:
+            self._plans.move_to_end(query_string)
+        else:
+            query_tree = self._plan(parser.parse(query_string))
+            self._plans[query_string] = self._compile(query_tree)
+            if len(self._plans) > self._plan_cache_size:
+                self._plans.popitem(last=False)
+
+        context = contextvars.copy_context()
+        context.run(bound_parameters.set, parameters)
+        result = context.run(self._plans[query_string], None)
+        return None if result is None else self._resume(context, result)
+
+    def _resume(self, context, result):
+        # runs every step of a lazy result in the context of the query that created it
+        iterator = iter(result)
+        while True:
+            try:
+                value = context.run(next, iterator)
+            except StopIteration:
+                return
+            yield value
+
+    def _plan(self, query_tree):
+        for node in list(query_tree.iter_subtrees()):
+            if node.data in ('query_statement', 'subquery'):
+                node.children = self._plan_clauses(node.children)
+        return query_tree
+
+    def _plan_clauses(self, clauses):
+        planned = []
+        match_clause = None
+        for clause in clauses:
+            if clause.data == 'match_clause':
+                clause = Tree('match_clause', [clause.children[0], Tree('match_where', []), Tree('match_order', [])])
+                match_clause = clause
+            elif clause.data == 'where_clause' and match_clause is not None:
+                # give the MATCH a hint about the filter, but keep the WHERE, because hints are only used for lookups
+                match_clause.children[1].children += self._conjuncts(clause.children[0])
+            elif (
+                    clause.data == 'order_by_clause' and match_clause is not None and match_clause is planned[0]
+                    and clause.children[0].data == 'source_variable'
+                    and str(clause.children[0].children[0]) in self._pattern_variables(match_clause.children[0])
+            ):
+                # a MATCH that starts a query has a single input context, so it can sort its own output (or scan a
+                # sorted index) and because sorting before filtering gives the same result we can skip the WHEREs
+                match_clause.children[2].children.append(clause.children[0])
+                match_clause = None
+                continue
+            else:
+                match_clause = None
+
+            planned.append(clause)
+
+        # an ORDER BY that is followed by a LIMIT only needs to keep the first rows
+        for j, clause in enumerate(planned):
+            limit = self._limit(planned[j + 1:])
+            if clause.data == 'order_by_clause' and limit is not None:
+                planned[j] = Tree('order_by_clause', [clause.children[0], Tree('order_limit', [limit])])
 
-    def _eval(self, node, result):
+        return planned
+
+    def _limit(self, clauses):
+        # the number of rows that clauses need from their input, if they start with a LIMIT (and maybe a SKIP)
+        if len(clauses) > 0 and clauses[0].data == 'limit_clause':
+            return int(clauses[0].children[0])
+        elif len(clauses) > 1 and clauses[0].data == 'skip_clause' and clauses[1].data == 'limit_clause':
+            return int(clauses[0].children[0]) + int(clauses[1].children[0])
+        else:
+            return None
+
+    def _conjuncts(self, expression):
+        if expression.data == 'source_and':
+            return self._conjuncts(expression.children[0]) + self._conjuncts(expression.children[1])
+        else:
+            return [expression]
+
+    def _pattern_variables(self, target_expression):
+        if target_expression.data != 'target_object':
+            return set()
+
+        return {
+            (
+                str(target_pair.children[0]) if target_pair.data == 'target_shorthand_pair'
+                else self._compile_identifier(target_pair.children[1])
+            )
+            for target_pair in target_expression.children
+            if target_pair.data == 'target_shorthand_pair'
+            or target_pair.data == 'target_full_pair' and target_pair.children[1].data == 'target_variable'
+        }
+
+    def _union_branches(self, node):
+        # UNION is left-associative, so a chain of them is a tree that leans to the left
+        if node.data == 'union_statement':
+            return self._union_branches(node.children[0]) + [node.children[1]]
+        else:
+            return [node]
+
+    def _partitioned_prefix(self, clauses):
+        # a MATCH that starts a query can be split into partitions of its candidates, unless it sorts them, and so can
+        # the clauses that follow it as long as they work on each row separately
+        if len(clauses) == 0 or clauses[0].data != 'match_clause' or len(clauses[0].children[2].children) > 0:
+            return 0
+
+        prefix = 1
+        while prefix < len(clauses) and (
+            clauses[prefix].data in ('match_clause', 'where_clause', 'return_clause')
+            or clauses[prefix].data == 'set_clause' and clauses[prefix].children[0].data != 'target_global'
+            or clauses[prefix].data == 'with_clause' and not self._contains_aggregate(clauses[prefix])
+        ):
+            prefix += 1
+        return prefix
+
+    def _is_read_only(self, node):
+        return not any(
+            subtree.data in ('create_clause', 'merge_clause', 'delete_clause', 'save_clause')
+            or subtree.data == 'set_clause' and subtree.children[0].data == 'target_global'
+            for subtree in node.iter_subtrees()
+        )
+
+    def _compile(self, node):
         if node.data == 'script':
             # start each statement with a single empty result and return the result of the last statement
-            for child in node.children:
-                result = self._eval(child, [{}])
-            return result
-        elif node.data == 'query_statement':
-            for child in node.children:
-                result = self._eval(child, result)
-            return result
-        elif node.data == 'union_statement':
-            left, right = node.children
-            left_result = self._eval(left, result)
-            right_result = self._eval(right, result)
-            if left_result is None:
-                return right_result
-            elif right_result is None:
-                return left_result
-            else:
-                return itertools.chain(left_result, right_result)
-        elif node.data == 'subquery':
+            statements = [self._compile(child) for child in node.children]
+
+            def run_script(result):
+                for statement in statements:
+                    self._statement_files = {}
+                    result = statement([{}])
+                return result
+
+            return run_script
+        elif node.data in ('query_statement', 'subquery'):
             # start with the context result and then apply each clause
-            for child in node.children:
-                result = self._eval(child, result)
-            return result
-        elif node.data == 'load_clause':
+            clauses = [self._compile(child) for child in node.children]
+
+            def run_clauses(result):
+                for clause in clauses:
+                    result = clause(result)
+                return result
+
+            if node.data == 'subquery' or self._workers is None or not self._is_read_only(node):
+                return run_clauses
+
+            prefix = self._partitioned_prefix(node.children)
+            if prefix == 0:
+                return run_clauses
+
+            # each partition only needs to produce as many rows as a LIMIT after the clauses that run in partitions
+            partition_limit = self._limit(node.children[prefix:])
+            target_expression, match_where, match_order = node.children[0].children
+            compiled_lookups = self._compile_lookups(target_expression)
+
+            def run_partition(result, partition):
+                result = clauses[0](result, partition)
+                for clause in clauses[1:prefix]:
+                    result = clause(result)
+                return itertools.islice(result, partition_limit)
+
+            def run_partitioned_clauses(result):
+                # the first MATCH and the clauses that work row by row run on partitions of its candidates, in order
+                if parallel.is_worker():
+                    return run_clauses(result)
+
+                # the candidates are found before deciding on the number of partitions, and the workers get them
+                # through the fork, so that a MATCH with only a few candidates doesn't fork any workers
+                result = list(result)
+                joins = {}
+                found = [
+                    self._candidate_records(compiled_lookups, context, joins, match_where.children)
+                    for context in result
+                ]
+                k = min(self._workers, sum(len(candidates) for candidates, ordered in found) // self._partition_size)
+                if k < 2:
+                    result = run_partition(result, (0, 1, found))
+                else:
+                    tasks = [lambda j=j: run_partition(result, (j, k, found)) for j in range(k)]
+                    result = itertools.chain.from_iterable(parallel.fork_map(tasks, k))
+
+                for clause in clauses[prefix:]:
+                    result = clause(result)
+                return result
+
+            return run_partitioned_clauses
+        elif node.data == 'union_statement':
+            branches = self._union_branches(node)
+            if self._workers is not None and all(self._is_read_only(branch) for branch in branches):
+                compiled_branches = [self._compile(branch) for branch in branches]
+
+                def run_parallel_union(result):
+                    # each branch runs against a forked snapshot of the session, and the results keep branch order
+                    tasks = [lambda branch=branch: branch(result) for branch in compiled_branches]
+                    return itertools.chain.from_iterable(parallel.fork_map(tasks, self._workers))
+
+                return run_parallel_union
+
+            left, right = map(self._compile, node.children)
+
+            def run_union(result):
+                left_result = left(result)
+                right_result = right(result)
+                if left_result is None:
+                    return right_result
+                elif right_result is None:
+                    return left_result
+                else:
+                    return itertools.chain(left_result, right_result)
+
+            return run_union
+        elif node.data in ('load_clause', 'load_unordered_clause'):
             file_format, file_path, target_expression = node.children
-            return self._load(result, file_format, file_path, target_expression)
+            compiled_path = self._compile_target(file_path)
+            compiled_target = self._compile_target(target_expression)
+            ordered = node.data == 'load_clause'
+            return lambda result: self._load(result, file_format, file_path, compiled_path, compiled_target, ordered)
         elif node.data == 'match_clause':
-            target_expression, = node.children
-            return self._match(result, target_expression)
-        elif node.data == 'with_clause':
-            return self._with(result, node)
+            target_expression, match_where, match_order = node.children
+            compiled_lookups = self._compile_lookups(target_expression)
+            compiled_target = self._compile_target(target_expression)
+            compiled_order = self._compile_source(match_order.children[0]) if len(match_order.children) > 0 else None
+            return lambda result, partition=None: self._match(
+                result, compiled_lookups, compiled_target, match_where.children, match_order.children, compiled_order,
+                partition
+            )
+        elif node.data in ('with_clause', 'with_distinct_clause'):
+            with_clause = Tree('with_clause', node.children)
+            compiled_projection = self._compile_projection(with_clause)
+            compiled_target = self._compile_target(with_clause)
+            distinct = node.data == 'with_distinct_clause'
+            return lambda result: self._with(result, distinct, compiled_projection, compiled_target)
         elif node.data == 'set_clause':
             target_expression, source_expression = node.children
-            return self._set(result, target_expression, source_expression)
+            compiled_source = self._compile_source(source_expression)
+            if target_expression.data == 'target_global':
+                key = str(target_expression.children[0])
+                return lambda result: self._set_global(result, key, compiled_source)
+            else:
+                compiled_target = self._compile_target(target_expression)
+                return lambda result: self._set(result, compiled_target, compiled_source)
         elif node.data == 'where_clause':
             source_expression, = node.children
-            return self._where(result, source_expression)
+            compiled_source = self._compile_source(source_expression)
+            return lambda result: self._where(result, compiled_source)
         elif node.data == 'order_by_clause':
-            source_expression, = node.children
-            return self._order_by(result, source_expression)
+            source_expression = node.children[0]
+            limit = node.children[1].children[0] if len(node.children) > 1 else None
+            compiled_source = self._compile_source(source_expression)
+            return lambda result: self._order_by(result, compiled_source, limit)
+        elif node.data == 'skip_clause':
+            n = int(node.children[0])
+            return lambda result: itertools.islice(result, n, None)
+        elif node.data == 'limit_clause':
+            n = int(node.children[0])
+            return lambda result: itertools.islice(result, n)
         elif node.data == 'create_clause':
             source_expression, = node.children
-            return self._create(result, source_expression)
+            compiled_source = self._compile_source(source_expression)
+            return lambda result: self._create(result, compiled_source)
         elif node.data == 'return_clause':
             source_expression, = node.children
-            return self._return(result, False, source_expression)
+            compiled_source = self._compile_source(source_expression)
+            return lambda result: self._return(result, False, compiled_source)
         elif node.data == 'return_distinct_clause':
             source_expression, = node.children
-            return self._return(result, True, source_expression)
+            compiled_source = self._compile_source(source_expression)
+            return lambda result: self._return(result, True, compiled_source)
         elif node.data == 'merge_clause':
             source_expression, target_expression = node.children
-            return self._merge(result, source_expression, target_expression)
+            compiled_projection, target_expression = self._compile_merge_projection(source_expression, target_expression)
+            compiled_lookups = self._compile_lookups(target_expression)
+            compiled_target = self._compile_target(target_expression)
+            return lambda result: self._merge(result, compiled_projection, compiled_lookups, compiled_target)
         elif node.data == 'delete_clause':
             target_expression, = node.children
-            return self._delete(result, target_expression)
+            compiled_lookups = self._compile_lookups(target_expression)
+            compiled_target = self._compile_target(target_expression)
+            return lambda result: self._delete(result, compiled_lookups, compiled_target)
         elif node.data == 'save_clause':
             file_format, source_expression, file_path = node.children
-            return self._save(result, file_format, source_expression, file_path)
+            compiled_source = self._compile_source(source_expression)
+            compiled_file_path = self._compile_source(file_path)
+            return lambda result: self._save(result, file_format, compiled_source, compiled_file_path)
         elif node.data == 'create_index_statement':
             name, target_expression = node.children
-            return self._create_index(name, target_expression)
+            return lambda result: self._create_index(name, target_expression, 'HASH')
+        elif node.data == 'create_sorted_index_statement':
+            name, target_expression = node.children
+            return lambda result: self._create_index(name, target_expression, 'SORTED')
+        elif node.data == 'create_text_index_statement':
+            name, target_expression = node.children
+            return lambda result: self._create_index(name, target_expression, 'TEXT')
         elif node.data == 'drop_index_statement':
             name, = node.children
-            return self._drop_index(name)
+            return lambda result: self._drop_index(name)
         elif isinstance(node, Tree):
             raise Exception(f'Node of type {node.data} not supported')
         else:
             raise Exception(f'Node {node} not supported')
 
-    def _load(self, input_result, file_format, file_path, target_expression):
+    def _load(self, input_result, file_format, file_path, compiled_path, compiled_target, ordered=True):
         if file_path.data == 'target_constant':
             file_list = [json.loads(file_path.children[0])]
         elif file_path.data == 'target_template':
@@ -298,217 +646,603 @@ class Session:
         else:
             raise Exception(f'Loading from node of type {file_path.data} not supported')
 
-        compiled_path = self._compile_target(file_path)
-        compiled_target = self._compile_target(target_expression)
-
         for context in input_result:
-            for file in file_list:
-                for match in compiled_path(file.replace('\\', '/')):
-                    if sat.cmp(context, match):
-                        subcontext = sat.cmb(context, match)
-                        with open(file, encoding='UTF-8') as fp:
-                            if file_format == 'JSON':
-                                source_value = json.load(fp)
-                                yield from (
-                                    sat.cmb(subcontext, match)
-                                    for match in compiled_target(source_value)
-                                    if sat.cmp(subcontext, match)
-                                )
-                            elif file_format == 'JSONL':
-                                for line in fp:
-                                    source_value = json.loads(line)
-                                    yield from (
-                                        sat.cmb(subcontext, match)
-                                        for match in compiled_target(source_value)
-                                        if sat.cmp(subcontext, match)
-                                    )
-                            elif file_format == 'TEXT':
-                                for line in fp:
-                                    source_value = line[:-1] if line.endswith('\n') else line
-                                    yield from (
-                                        sat.cmb(subcontext, match)
-                                        for match in compiled_target(source_value)
-                                        if sat.cmp(subcontext, match)
-                                    )
-                            else:
-                                raise Exception(f'File format {file_format} not supported')
-
-    def _create(self, input_result, source_expression):
-        compiled_source = self._compile_source(source_expression)
+            files = [
+                (file, sat.cmb(context, match))
+                for file in file_list
+                for match in compiled_path(file.replace('\\', '/'))
+                if sat.cmp(context, match)
+            ]
+
+            if len(files) > 1 and self._io_workers > 1:
+                # read and decode the files on a pool of threads, in order (or as they're done for LOAD UNORDERED)
+                loaded = parallel.thread_map(
+                    lambda file: (file[1], list(self._read_cached_values(file_format, file[0]))),
+                    files, self._io_workers, ordered
+                )
+            else:
+                loaded = ((subcontext, self._read_cached_values(file_format, file)) for file, subcontext in files)
+
+            for subcontext, source_values in loaded:
+                yield from (
+                    sat.cmb(subcontext, match)
+                    for source_value in source_values
+                    for match in compiled_target(source_value)
+                    if sat.cmp(subcontext, match)
+                )
+
+    def _read_cached_values(self, file_format, file):
+        # NOTE: cached values are shared by every LOAD of the file, so they must never be changed in place
+        key = file_format, os.path.abspath(file)
+        with self._file_lock:
+            if key in self._statement_files:
+                return self._statement_files[key]
+
+        stat = os.stat(file)
+        version = stat.st_mtime_ns, stat.st_size
+        with self._file_lock:
+            cached = self._file_cache.get(key)
+            if cached is not None and cached[0] == version:
+                self._file_cache.move_to_end(key)
+                return self._statement_files.setdefault(key, cached[1])
+
+        if stat.st_size > min(cached_file_size, self._file_cache_size):
+            return self._read_values(file_format, file)
+
+        # the file is decoded outside of the lock, so that other threads can read other files in the meantime
+        values = list(self._read_values(file_format, file))
+        with self._file_lock:
+            if key in self._statement_files:
+                return self._statement_files[key]
+
+            self._uncache_file(key)
+            self._file_cache[key] = version, values
+            self._file_cache_used += stat.st_size
+            while self._file_cache_used > self._file_cache_size:
+                self._uncache_file(next(iter(self._file_cache)))
+            self._statement_files[key] = values
+            return values
+
+    def _uncache_file(self, key):
+        self._statement_files.pop(key, None)
+        if key in self._file_cache:
+            version, values = self._file_cache.pop(key)
+            self._file_cache_used -= version[1]
+
+    def _forget_file(self, file):
+        with self._file_lock:
+            for file_format in ('JSON', 'JSONL', 'TEXT'):
+                self._uncache_file((file_format, os.path.abspath(file)))
+
+    def _read_values(self, file_format, file):
+        if file_format == 'JSON':
+            with open(file, encoding='UTF-8') as fp:
+                yield json.load(fp)
+        elif file_format == 'JSONL':
+            # JSONL files are read in chunks and decoded in batches, which is a lot faster than line by line
+            with open(file, 'rb') as fp:
+                for batch in codec.read_batches(fp):
+                    yield from batch
+        elif file_format == 'TEXT':
+            with open(file, encoding='UTF-8') as fp:
+                for line in fp:
+                    yield line[:-1] if line.endswith('\n') else line
+        else:
+            raise Exception(f'File format {file_format} not supported')
 
+    def _create(self, input_result, compiled_source):
         for context in input_result:
-            self._records.append(compiled_source(context))
+            self._insert_record(compiled_source(context))
 
-        self._update_indexes()
         return input_result
 
-    def _return(self, input_result, distinct, source_expression):
-        compiled_source = self._compile_source(source_expression)
-
+    def _return(self, input_result, distinct, compiled_source):
+        output_result = (compiled_source(context) for context in input_result)
         if distinct:
-            found = set()
-            for context in input_result:
-                value = compiled_source(context)
-                value_json = json.dumps(value)
-                if value_json not in found:
-                    found.add(value_json)
-                    yield value
-        else:
-            for context in input_result:
-                yield compiled_source(context)
+            output_result = self._distinct(output_result)
 
-    def _merge(self, input_result, source_expression, target_expression):
-        compiled_projection, target_expression = self._compile_merge_projection(source_expression, target_expression)
-        # compiled_source = self._compile_source(source_expression)
-        compiled_target = self._compile_target(target_expression)
+        yield from output_result
+
+    def _distinct(self, values, key=lambda x: x):
+        found = set()
+        for value in values:
+            k = self._distinct_key(key(value))
+            if k not in found:
+                found.add(k)
+                yield value
 
+    def _merge(self, input_result, compiled_projection, compiled_lookups, compiled_target):
         # TODO: first generate changeset so that changes are isolated from reading query???
 
+        joins = {}
         for patch, context in compiled_projection(input_result):
-            for i, record in self._candidate_records(target_expression, context):
+            candidates, ordered = self._candidate_records(compiled_lookups, context, joins)
+            for i, record in candidates:
                 if any(sat.cmp(context, match) for match in compiled_target(record)):
-                    self._records[i] = sat.cmb(record, patch)
+                    version = self._version
+                    self._update_record(i, sat.cmb(record, patch))
+                    self._update_joins(joins, version, i, record, self._records[i])
 
-        self._update_indexes()
         return None
 
-    def _delete(self, input_result, target_expression):
-        compiled_target = self._compile_target(target_expression)
+    def _delete(self, input_result, compiled_lookups, compiled_target):
         delete_set = set()
 
+        joins = {}
         for context in input_result:
-            for i, record in self._candidate_records(target_expression, context):
+            candidates, ordered = self._candidate_records(compiled_lookups, context, joins)
+            for i, record in candidates:
                 if any(sat.cmp(context, match) for match in compiled_target(record)):
                     delete_set |= {i}
 
-        self._records = [
-            record
-            for i, record in enumerate(self._records)
-            if i not in delete_set
-        ]
+        for i in delete_set:
+            self._delete_record(i)
 
-        self._update_indexes()
         return None
 
-    def _candidate_records(self, target_expression, context):
-        simplified_target = self._simplify_target(target_expression, context)
-
-        index_name = None
-        lookup_key = None
-        for name, key_expression in self._index_keys.items():
-            lookup_key = self._calc_lookup_key(simplified_target, key_expression)
-            if lookup_key is not None:
-                index_name = name
-                break
+    def _candidate_records(self, compiled_lookups, context, joins=None, conjuncts=(), order=()):
+        compiled_fields, compiled_lookup_key = compiled_lookups
+        fields = compiled_fields(context)
+        order_variable = str(order[0].children[0]) if len(order) > 0 else None
+
+        # collect the postings of the hash and text indexes that cover the pattern, and only count the ids in the
+        # ranges of the sorted indexes, so that we can start from the smallest one and probe the postings with its ids
+        postings = []
+        scans = []
+        for name, index in self._index_records.items():
+            if isinstance(index, indexing.SortedIndex):
+                scan, ordered = self._plan_sorted_index(index, fields, conjuncts, order_variable)
+                if scan is not None:
+                    scans.append((index.count(*scan), not ordered, index, scan))
+            elif isinstance(index, indexing.TextIndex):
+                postings += self._search_text_index(index, fields, conjuncts)
+            else:
+                lookup_key = compiled_lookup_key(name, context)
+                if lookup_key is not missing:
+                    postings.append(index.get(lookup_key))
+
+        # the ranges of sorted indexes other than the smallest aren't probed, because every candidate is matched anyway
+        scan = min(scans, key=lambda x: x[:2]) if len(scans) > 0 else None
+        if scan is not None and (len(postings) == 0 or scan[0] < min(len(p) for p in postings)):
+            count, unordered, index, scan = scan
+            ids = index.scan(*scan)
+            # take a snapshot, so that writes further down the pipeline don't affect the records we are iterating over
+            return [
+                (i, self._records[i])
+                for i in (sorted(ids) if unordered else ids)
+                if all(indexing.has(p, i) for p in postings)
+            ], not unordered
+        elif len(postings) > 0:
+            return [
+                (i, self._records[i])
+                for i in indexing.isect(postings)
+            ], False
+        else:
+            return self._scan_records(fields, joins), False
+
+    def _scan_records(self, fields, joins):
+        # without an index, a clause that scans the records for more than one context joins the contexts with the
+        # records using a hash table on the attributes that have a known value, which is built on the second scan
+        join_fields = tuple(sorted(field for field, (kind, value) in fields.items() if kind == 'eq'))
+        if joins is None or len(join_fields) == 0:
+            return self._select_records(fields, join_fields)
+
+        if join_fields not in joins or joins[join_fields][0] != self._version:
+            joins[join_fields] = self._version, None
+            return self._select_records(fields, join_fields)
+
+        if joins[join_fields][1] is None:
+            table = indexing.HashIndex()
+            for i, record in self._records.items():
+                join_key = self._join_key(record, join_fields)
+                if join_key is not missing:
+                    table.add(i, join_key)
+            joins[join_fields] = self._version, table
+
+        return [
+            (i, self._records[i])
+            for i in joins[join_fields][1].get({field: fields[field][1] for field in join_fields})
+        ]
 
-        if lookup_key is not None:
-            record_key = json.dumps(lookup_key)
-            return (
+    def _join_key(self, record, join_fields):
+        if isinstance(record, dict) and all(field in record for field in join_fields):
+            return {field: record[field] for field in join_fields}
+        else:
+            return missing
+
+    def _update_joins(self, joins, version, i, old_record, new_record):
+        # a clause that changes records itself (like MERGE) keeps its hash tables up to date, instead of throwing
+        # them away because the records changed
+        for join_fields, (table_version, table) in joins.items():
+            if table_version != version:
+                continue
+            if table is not None:
+                for record, update in ((old_record, table.remove), (new_record, table.add)):
+                    join_key = self._join_key(record, join_fields)
+                    if join_key is not missing:
+                        update(i, join_key)
+            joins[join_fields] = self._version, table
+
+    def _select_records(self, fields, join_fields):
+        # columns can be compared to the known values of a pattern, without turning every row into a record
+        if isinstance(self._records, columnar.ColumnStore) and len(join_fields) > 0:
+            return [
                 (i, self._records[i])
-                for i in self._index_records[index_name].get(record_key, set())
+                for i in self._records.select({field: fields[field][1] for field in join_fields})
+            ]
+        else:
+            return list(self._records.items())
+
+    def _compile_lookups(self, target_expression):
+        # an alias binds the whole record, so only the pattern it wraps can be looked up
+        while target_expression.data == 'target_alias':
+            target_expression = target_expression.children[0]
+
+        # everything that doesn't depend on the context is compiled once per clause (and index), so that finding
+        # the candidate records for a context only needs to pull values from that context
+        compiled_keys = {}
+
+        def compiled_lookup_key(name, context):
+            key_expression = self._index_keys[name]
+            if name not in compiled_keys or compiled_keys[name][0] is not key_expression:
+                compiled_keys[name] = key_expression, self._compile_lookup_key(target_expression, key_expression)
+            compiled_key = compiled_keys[name][1]
+            return missing if compiled_key is None else compiled_key(context)
+
+        return self._compile_pattern_fields(target_expression), compiled_lookup_key
+
+    def _pattern_pairs(self, target_expression):
+        # attributes with a default value also match records without that attribute, so we can't use them
+        pairs = {}
+        for target_pair in target_expression.children:
+            if target_pair.data == 'target_shorthand_pair' and len(target_pair.children) == 1:
+                pairs[str(target_pair.children[0])] = Tree('target_variable', target_pair.children)
+            elif target_pair.data == 'target_full_pair' and len(target_pair.children) == 2:
+                pairs[str(target_pair.children[0])] = target_pair.children[1]
+        return pairs
+
+    def _compile_pattern_fields(self, target_expression):
+        if target_expression.data != 'target_object':
+            return lambda c: {}
+
+        compiled_fields = []
+        for field, value in self._pattern_pairs(target_expression).items():
+            compiled_value = self._compile_lookup_value(value)
+            if value.data in ('target_variable', 'target_unwind'):
+                kind = 'var' if value.data == 'target_variable' else 'unwind'
+                key = self._compile_identifier(value if value.data == 'target_variable' else value.children[0])
+                compiled_fields.append((field, lambda c, kind=kind, key=key, compiled_value=compiled_value: (
+                    (kind, key) if not sat.has(key, c)
+                    else ('eq', compiled_value(c)) if compiled_value is not None
+                    else missing
+                )))
+            elif compiled_value is not None:
+                compiled_fields.append((field, expr.uni(lambda v: ('eq', v), compiled_value)))
+            elif value.data == 'target_template' and isinstance(value.children[0], str):
+                prefix = re.sub(r'^`|^}|`$|\${$', '', value.children[0])
+                compiled_fields.append((field, expr.lit(('prefix', prefix))))
+
+        return lambda c: {
+            field: value
+            for field, compiled_field in compiled_fields
+            for value in [compiled_field(c)]
+            if value is not missing and value[1] is not missing
+        }
+
+    def _compile_lookup_value(self, expression):
+        # compiles a function that returns the value a pattern requires in a given context, or missing (templates
+        # match any string that starts with them, so they are left to the prefix lookups)
+        if expression.data == 'target_constant':
+            return expr.lit(json.loads(expression.children[0]))
+        elif expression.data == 'target_parameter':
+            k = str(expression.children[0])[1:]
+            return lambda c: bound_parameters.get()[k]
+        elif expression.data == 'target_alias':
+            return self._compile_lookup_value(expression.children[0])
+        elif expression.data == 'target_variable':
+            k = self._compile_identifier(expression)
+            # constraints and (partially matching) objects can't be looked up
+            return lambda c: (
+                sat.get(k, c) if sat.has(k, c) and not callable(sat.get(k, c)) and not isinstance(sat.get(k, c), dict)
+                else missing
             )
+        elif expression.data == 'target_key':
+            i = int(expression.children[0])
+            return lambda c: c['$keys'][i] if '$keys' in c and len(c['$keys']) > i else missing
         else:
-            return enumerate(self._records)
+            return None
 
-    def _match(self, input_result, target_expression):
-        compiled_target = self._compile_target(target_expression)
+    def _compile_lookup_key(self, target_expression, key_expression):
+        # compiles a function that returns the key to look up in an index in a given context, or missing, or None if
+        # the index can never be used for the pattern
+        if target_expression.data == 'target_object' and key_expression.data == 'target_object':
+            pairs = self._pattern_pairs(target_expression)
+            has_rest = any(child.data == 'target_rest_expression' for child in target_expression.children)
 
-        for context in input_result:
-            yield from (
+            compiled_parts = []
+            for child in key_expression.children:
+                if child.data == 'target_shorthand_pair':
+                    key = str(child.children[0])
+                    compiled_part = self._compile_lookup_key(pairs[key], Tree('target_variable', child.children[:1])) \
+                        if key in pairs else None
+                elif child.data == 'target_full_pair':
+                    key = str(child.children[0])
+                    compiled_part = self._compile_lookup_key(pairs[key], child.children[1]) if key in pairs else None
+                elif child.data == 'target_rest_expression' and has_rest:
+                    continue
+                else:
+                    compiled_part = None
+
+                if compiled_part is None:
+                    return None
+                compiled_parts.append(compiled_part)
+
+            def compiled_lookup_key(c):
+                lookup_key = {}
+                for compiled_part in compiled_parts:
+                    part = compiled_part(c)
+                    if part is missing:
+                        return missing
+                    lookup_key = sat.cmb(lookup_key, part)
+                return lookup_key
+
+            return compiled_lookup_key
+        elif key_expression.data == 'target_variable':
+            compiled_value = self._compile_lookup_value(target_expression)
+            if compiled_value is None:
+                return None
+            key = str(key_expression.children[0])
+            return lambda c: missing if compiled_value(c) is missing else sat.ctx(key, compiled_value(c))
+        else:
+            return None
+
+    def _plan_sorted_index(self, index, fields, conjuncts, order_variable):
+        # returns the arguments of a scan of the index and whether it gives the ids in order, or None
+        eq = []
+        for field in index.variables:
+            kind, value = fields.get(field, (None, None))
+            if kind == 'eq' and indexing.exact(value):
+                eq.append(value)
+            elif kind == 'prefix':
+                return (eq, None, None, value), False
+            elif kind == 'var':
+                lo, hi = self._calc_bounds(value, conjuncts)
+                if lo is not None or hi is not None or value == order_variable:
+                    return (eq, lo, hi), value == order_variable
+                break
+            else:
+                break
+
+        if len(eq) > 0:
+            return (eq,), False
+        else:
+            return None, False
+
+    def _search_text_index(self, index, fields, conjuncts):
+        variables = {
+            value: field
+            for field, (kind, value) in fields.items()
+            if kind in ('var', 'unwind') and field in index.variables
+        }
+
+        postings = []
+        for conjunct in conjuncts:
+            if conjunct.data != 'source_method_call' or str(conjunct.children[1]) not in ('includes', 'match'):
+                continue
+
+            subject, method, arguments = conjunct.children
+            if subject.data != 'source_variable' or str(subject.children[0]) not in variables:
+                continue
+            if len(arguments.children) != 1 or arguments.children[0].data != 'source_constant':
+                continue
+
+            text = json.loads(arguments.children[0].children[0])
+            if not isinstance(text, str):
+                continue
+
+            variable = variables[str(subject.children[0])]
+            postings += index.postings(variable, text if method == 'includes' else indexing.lit(text))
+
+        return postings
+
+    def _calc_bounds(self, variable, conjuncts):
+        # == compares values like Python (1 == 1.0 == true) instead of by collation key, so it can't give bounds
+        lo = None
+        hi = None
+        for conjunct in conjuncts:
+            if conjunct.data not in ('source_lt', 'source_le', 'source_gt', 'source_ge'):
+                continue
+
+            left, right = conjunct.children
+            if left.data == 'source_variable' and str(left.children[0]) == variable and right.data == 'source_constant':
+                op, value = conjunct.data, json.loads(right.children[0])
+            elif right.data == 'source_variable' and str(right.children[0]) == variable and left.data == 'source_constant':
+                op, value = self._flipped_comparisons[conjunct.data], json.loads(left.children[0])
+            else:
+                continue
+
+            if op in ('source_gt', 'source_ge'):
+                bound = (value, op != 'source_gt')
+                if lo is None or indexing.col(bound[0]) > indexing.col(lo[0]):
+                    lo = bound
+            if op in ('source_lt', 'source_le'):
+                bound = (value, op != 'source_lt')
+                if hi is None or indexing.col(bound[0]) < indexing.col(hi[0]):
+                    hi = bound
+
+        return lo, hi
+
+    _flipped_comparisons = {
+        'source_lt': 'source_gt',
+        'source_le': 'source_ge',
+        'source_gt': 'source_lt',
+        'source_ge': 'source_le',
+    }
+
+    def _match(self, input_result, compiled_lookups, compiled_target, conjuncts, order, compiled_order, partition=None):
+        # a partition (j, k, found) matches part j of k of the candidates that were found for each context before
+        joins = {}
+        for n, context in enumerate(input_result):
+            if partition is None:
+                candidates, ordered = self._candidate_records(compiled_lookups, context, joins, conjuncts, order)
+            else:
+                j, k, found = partition
+                candidates, ordered = found[n]
+                candidates = candidates[len(candidates) * j // k:len(candidates) * (j + 1) // k]
+            output_result = (
                 sat.cmb(context, match)
-                for i, record in self._candidate_records(target_expression, context)
+                for i, record in candidates
                 for match in compiled_target(record)
                 if sat.cmp(context, match)
             )
 
-    def _with(self, input_result, with_clause):
-        compiled_projection = self._compile_projection(with_clause)
-        compiled_target = self._compile_target(with_clause)
+            if compiled_order is not None and not ordered:
+                yield from sorting.sort(
+                    output_result, lambda x: indexing.col(compiled_order(x)), budget=self._sort_budget
+                )
+            else:
+                yield from output_result
 
+    def _with(self, input_result, distinct, compiled_projection, compiled_target):
         # NOTE: no check compatibility and no combine
         # matches from WITH should hide input variables, so we throw away all the input variables
-        for value, context in compiled_projection(input_result):
+        output_result = compiled_projection(input_result)
+        if distinct:
+            output_result = self._distinct(output_result, key=lambda x: x[0])
+
+        for value, context in output_result:
             for match in compiled_target(value):
                 yield match
 
-    def _set(self, input_result, target_expression, source_expression):
-        if target_expression.data == 'target_global':
-            compiled_source = self._compile_source(source_expression)
-
-            for context in input_result:
-                key = str(target_expression.children[0])
-                value = compiled_source(context)
-                self._globals[key] = value
-
-            return input_result
-        else:
-            compiled_target = self._compile_target(target_expression)
-            compiled_source = self._compile_source(source_expression)
-            output_result = []
-
-            for context in input_result:
-                # NOTE: no check compatibility but combine to make sure we keep the new value
-                output_result += [
-                    sat.cmb(context, match)
-                    for match in compiled_target(compiled_source(context))
-                ]
+    def _set_global(self, input_result, key, compiled_source):
+        for context in input_result:
+            value = compiled_source(context)
+            self._globals[key] = value
 
-            return output_result
+        return input_result
 
-    def _where(self, input_result, source_expression):
-        compiled_source = self._compile_source(source_expression)
+    def _set(self, input_result, compiled_target, compiled_source):
+        for context in input_result:
+            # NOTE: no check compatibility but combine to make sure we keep the new value
+            yield from (
+                sat.cmb(context, match)
+                for match in compiled_target(compiled_source(context))
+            )
 
+    def _where(self, input_result, compiled_source):
         for context in input_result:
             if compiled_source(context):
                 yield context
 
-    def _order_by(self, input_result, source_expression):
-        compiled_source = self._compile_source(source_expression)
+    def _order_by(self, input_result, compiled_source, limit=None):
+        return sorting.sort(
+            input_result, lambda x: indexing.col(compiled_source(x)), limit=limit, budget=self._sort_budget
+        )
 
-        return sorted(input_result, key=lambda x: json.dumps(compiled_source(x)))
-
-    def _save(self, input_result, file_format, source_expression, file_path):
-        compiled_source = self._compile_source(source_expression)
-        compiled_file_path = self._compile_source(file_path)
-
-        for file_path_string, input_result_group in itertools.groupby(input_result, compiled_file_path):
-            with open(file_path_string, 'w', encoding='UTF-8') as fp:
-                for context in input_result_group:
-                    if file_format == 'JSONL':
-                        json.dump(compiled_source(context), fp)
-                        fp.write('\n')
-                    elif file_format == 'TEXT':
-                        fp.write(compiled_source(context))
-                        fp.write('\n')
-                    else:
-                        raise Exception(f'File format {file_format} not supported')
+    def _save(self, input_result, file_format, compiled_source, compiled_file_path):
+        # every file is truncated once, even if its contexts aren't next to each other, and written to in batches, with
+        # only a bounded number of files open at a time
+        writers = output.Writers(self._io_workers)
+        try:
+            for context in input_result:
+                if file_format == 'JSONL':
+                    line = json.dumps(compiled_source(context)) + '\n'
+                elif file_format == 'TEXT':
+                    line = compiled_source(context) + '\n'
+                else:
+                    raise Exception(f'File format {file_format} not supported')
+                writers.write(compiled_file_path(context), line)
+        finally:
+            writers.close()
+            for file_path_string in writers.paths():
+                self._forget_file(file_path_string)
 
         return None
 
-    def _create_index(self, name, key_expression):
+    def _create_index(self, name, key_expression, index_type, postings=None):
         if name in self._index_keys:
             raise Exception(f'Index {name} already exists')
 
+        if index_type == 'SORTED':
+            index = indexing.SortedIndex(self._index_variables(key_expression))
+        elif index_type == 'TEXT':
+            index = indexing.TextIndex(self._index_variables(key_expression))
+        else:
+            index = indexing.HashIndex()
+
         self._index_keys[name] = key_expression
+        self._index_compiled_keys[name] = self._compile_target(key_expression)
+        self._index_records[name] = index
+
+        if postings is not None:
+            index.load(postings)
+        else:
+            for i, record in self._records.items():
+                self._index_record(name, i, record)
 
-        self._update_indexes()
         return None
 
+    def _index_variables(self, key_expression):
+        if key_expression.data != 'target_object':
+            raise Exception(f'Index on node of type {key_expression.data} not supported')
+
+        variables = []
+        for target_pair in key_expression.children:
+            if target_pair.data == 'target_shorthand_pair' and len(target_pair.children) == 1:
+                variables.append(str(target_pair.children[0]))
+            else:
+                raise Exception(f'Index on node of type {target_pair.data} not supported')
+
+        return variables
+
     def _drop_index(self, name):
         del self._index_keys[name]
+        del self._index_compiled_keys[name]
+        del self._index_records[name]
 
         return None
 
-    def _update_indexes(self):
-        for name, key_expression in self._index_keys.items():
-            compiled_key = self._compile_target(key_expression)
-            self._index_records[name] = {}
-            for i, record in enumerate(self._records):
-                for match in compiled_key(record):
-                    record_key = json.dumps(match)
-                    if record_key not in self._index_records[name]:
-                        self._index_records[name][record_key] = set()
-                    self._index_records[name][record_key] |= {i}
+    def _insert_record(self, record):
+        self._version += 1
+        i = self._next_id
+        self._next_id += 1
+        self._records[i] = record
+
+        for name in self._index_keys:
+            self._index_record(name, i, record)
+
+    def _update_record(self, i, record):
+        self._version += 1
+        for name in self._index_keys:
+            self._unindex_record(name, i, self._records[i])
+
+        self._records[i] = record
+
+        for name in self._index_keys:
+            self._index_record(name, i, record)
+
+    def _delete_record(self, i):
+        self._version += 1
+        for name in self._index_keys:
+            self._unindex_record(name, i, self._records[i])
+
+        del self._records[i]
+
+    def _index_matches(self, name, record):
+        # sorted and text indexes also keep records that have only some of their variables
+        index = self._index_records[name]
+        if isinstance(index, (indexing.SortedIndex, indexing.TextIndex)):
+            return [{k: record[k] for k in index.variables if k in record}] if isinstance(record, dict) else []
+        else:
+            return self._index_compiled_keys[name](record)
+
+    def _index_record(self, name, i, record):
+        for match in self._index_matches(name, record):
+            self._index_records[name].add(i, match)
+
+    def _unindex_record(self, name, i, record):
+        for match in self._index_matches(name, record):
+            self._index_records[name].remove(i, match)
 
     def _compile_identifier(self, expression):
         if isinstance(expression, Token):
@@ -563,6 +1297,9 @@ class Session:
             return destructuring.tup(elements, rest)
         elif expression.data == 'target_constant':
             return destructuring.lit(json.loads(expression.children[0]))
+        elif expression.data == 'target_parameter':
+            k = str(expression.children[0])[1:]
+            return destructuring.ref(lambda: bound_parameters.get()[k])
         elif expression.data == 'target_alias':
             return destructuring.als(self._compile_target(expression.children[0]), str(expression.children[1]))
         elif expression.data == 'target_variable':
@@ -597,9 +1334,11 @@ class Session:
     def _contains_aggregate(self, expression):
         if expression.data == 'source_variable':
             return False
+        elif expression.data == 'source_parameter':
+            return False
         elif expression.data == 'source_constant':
             return False
-        elif expression.data == 'source_aggregate':
+        elif expression.data in ('source_aggregate', 'source_aggregate_function', 'source_aggregate_distinct'):
             return True
         elif expression.data == 'source_object':
             return any(self._contains_aggregate(child) for child in expression.children)
@@ -629,7 +1368,7 @@ class Session:
             raise Exception(f'Node of type {expression.data} not supported')
 
     def _extract_keys(self, expression, keys):
-        if expression.data == 'source_aggregate':
+        if expression.data in ('source_aggregate', 'source_aggregate_function', 'source_aggregate_distinct'):
             return keys, expression
         elif expression.data in (
                 'with_clause', 'source_object', 'source_full_pair', 'source_constant',
@@ -652,7 +1391,7 @@ class Session:
             target_variable = Tree('target_variable', source_variable.children)
             keys, source_variable = self._extract_keys(source_variable, keys)
             return keys, Tree('with_full_pair', [source_variable, target_variable])
-        elif expression.data == 'source_variable':
+        elif expression.data in ('source_variable', 'source_parameter'):
             return keys + [expression], Tree('source_key', [Token('INT', len(keys))])
         elif expression.data == 'target_shorthand_pair':
             target_key = expression.children[0]
@@ -665,11 +1404,43 @@ class Session:
         else:
             raise Exception(f'Node of type {expression.data} not supported')
 
+    def _extract_aggregates(self, expression, aggregates):
+        # replaces the aggregates in a grouped expression with references to the values of their aggregators
+        if isinstance(expression, Token):
+            return aggregates, expression
+        elif expression.data in ('source_aggregate', 'source_aggregate_function', 'source_aggregate_distinct'):
+            return aggregates + [expression], Tree('source_aggregate_value', [Token('INT', len(aggregates))])
+        else:
+            new_children = []
+            for child in expression.children:
+                aggregates, new_child = self._extract_aggregates(child, aggregates)
+                new_children.append(new_child)
+            return aggregates, Tree(expression.data, new_children)
+
+    def _compile_aggregate(self, expression):
+        if expression.data == 'source_aggregate':
+            return expr.agg_collect(self._compile_source(expression.children[0]))
+        elif expression.data == 'source_aggregate_distinct':
+            return expr.agg_distinct(self._compile_source(expression.children[0]), self._distinct_key)
+        elif expression.data == 'source_aggregate_function':
+            aggregate = {
+                'COUNT': expr.agg_count,
+                'SUM': expr.agg_sum,
+                'MIN': expr.agg_min,
+                'MAX': expr.agg_max,
+                'COLLECT': expr.agg_collect,
+            }[str(expression.children[0]).upper()]
+            return aggregate(self._compile_source(expression.children[1]))
+        else:
+            raise Exception(f'Aggregate of type {expression.data} not supported')
+
     def _compile_projection(self, expression):
         if self._contains_aggregate(expression):
             keys, grouped_expression = self._extract_keys(expression, [])
+            aggregates, grouped_expression = self._extract_aggregates(grouped_expression, [])
             return expr.grp_ret(
                 expr.arr([expr.el(self._compile_source(key)) for key in keys]),
+                [self._compile_aggregate(aggregate) for aggregate in aggregates],
                 self._compile_source(grouped_expression)
             )
         else:
@@ -679,8 +1450,10 @@ class Session:
         if self._contains_aggregate(source_expression):
             keys, grouped_target_expression = self._extract_keys(target_expression, [])
             keys, grouped_source_expression = self._extract_keys(source_expression, keys)
+            aggregates, grouped_source_expression = self._extract_aggregates(grouped_source_expression, [])
             return expr.grp_ret(
                 expr.arr([expr.el(self._compile_source(key)) for key in keys]),
+                [self._compile_aggregate(aggregate) for aggregate in aggregates],
                 self._compile_source(grouped_source_expression)
             ), grouped_target_expression
         else:
@@ -702,7 +1475,7 @@ class Session:
                 return expr.bin(lambda o, a: o.strip(), subject, arguments)
             elif expression.children[1] == 'match':
                 to_arr_or_null = lambda x: [x[0], *x.groups()] if x is not None else None
-                return expr.bin(lambda o, a: to_arr_or_null(re.search(a[0], o)), subject, arguments)
+                return expr.bin(lambda o, a: to_arr_or_null(self._regex(a[0]).search(o)), subject, arguments)
             else:
                 raise Exception(f'Method {expression.children[1]} not supported')
         elif expression.data == 'source_property':
@@ -721,6 +1494,16 @@ class Session:
             left = self._compile_source(expression.children[0])
             right = self._compile_source(expression.children[1])
             return expr.bin(lambda l, r: l != r, left, right)
+        elif expression.data in ('source_lt', 'source_le', 'source_gt', 'source_ge'):
+            left = self._compile_source(expression.children[0])
+            right = self._compile_source(expression.children[1])
+            compare = {
+                'source_lt': lambda l, r: l < r,
+                'source_le': lambda l, r: l <= r,
+                'source_gt': lambda l, r: l > r,
+                'source_ge': lambda l, r: l >= r,
+            }[expression.data]
+            return expr.bin(lambda l, r: compare(indexing.col(l), indexing.col(r)), left, right)
         elif expression.data == 'source_and':
             left = self._compile_source(expression.children[0])
             right = self._compile_source(expression.children[1])
@@ -736,6 +1519,10 @@ class Session:
             format = str(expression.children[1])
             right = self._compile_source(expression.children[2])
             return expr.bin(lambda l, r: not self._validate(format, l, r), left, right)
+        elif expression.data == 'source_matches_any':
+            left = self._compile_source(expression.children[0])
+            right = self._compile_source(expression.children[1])
+            return expr.bin(lambda l, r: self._pattern_set(r).matches(l), left, right)
         elif expression.data == 'source_add':
             left = self._compile_source(expression.children[0])
             right = self._compile_source(expression.children[1])
@@ -756,6 +1543,9 @@ class Session:
         elif expression.data == 'source_global':
             k = str(expression.children[0])
             return lambda c: self._globals[k]
+        elif expression.data == 'source_parameter':
+            k = str(expression.children[0])[1:]
+            return lambda c: bound_parameters.get()[k]
         elif expression.data == 'source_star':
             return expr.star()
         elif expression.data == 'source_object':
@@ -776,14 +1566,21 @@ class Session:
             return expr.el(self._compile_source(expression.children[0]))
         elif expression.data == 'source_spread_expression':
             return self._compile_source(expression.children[0])
-        elif expression.data == 'source_aggregate':
-            return expr.grp_arr(self._compile_source(expression.children[0]))
+        elif expression.data == 'source_aggregate_value':
+            return expr.grp_agg(int(expression.children[0]))
         elif expression.data == 'source_subquery_exists':
+            # compile the subquery once, so that each outer context only needs to run it
             subquery = expression.children[0]
-            return lambda c: any(True for _ in self._eval(subquery, [c]))
+            compiled_subquery = self._compile(subquery)
+            if self._is_semi_join(subquery):
+                return self._compile_semi_join(subquery.children[0].children[0], compiled_subquery)
+            elif self._is_pattern_match(subquery):
+                return self._compile_pattern_match(subquery, compiled_subquery)
+            else:
+                return lambda c: any(True for _ in compiled_subquery([c]))
         elif expression.data == 'source_subquery_array':
-            subquery = expression.children[0]
-            return lambda c: list(self._eval(subquery, [c]))
+            compiled_subquery = self._compile(expression.children[0])
+            return lambda c: list(compiled_subquery([c]))
         elif expression.data == 'with_clause':
             elements = [self._compile_source(child) for child in expression.children]
             return expr.arr(elements)
@@ -823,6 +1620,122 @@ class Session:
         else:
             raise Exception(f'Node of type {expression.data} not supported')
 
+    def _is_semi_join(self, subquery):
+        if len(subquery.children) != 1 or subquery.children[0].data != 'match_clause':
+            return False
+
+        target_expression = subquery.children[0].children[0]
+        return target_expression.data == 'target_object' and all(
+            target_pair.data == 'target_shorthand_pair' and len(target_pair.children) == 1
+            or target_pair.data == 'target_full_pair' and len(target_pair.children) == 2
+            and target_pair.children[1].data in ('target_variable', 'target_constant')
+            for target_pair in target_expression.children
+        )
+
+    def _compile_semi_join(self, target_expression, compiled_subquery):
+        # EXISTS (MATCH {...}) only depends on the pattern variables bound by the outer context, so instead of running
+        # the MATCH for every outer context, we build a hash table of their values once and probe it
+        compiled_target = self._compile_target(target_expression)
+        compiled_fields, compiled_lookup_key = self._compile_lookups(target_expression)
+        variables = sorted(self._pattern_variables(target_expression))
+        tables = {}
+
+        def build_table(bound, context):
+            # lookups in an index are just as fast as probing a hash table, so then we just run the subquery
+            if any(
+                    compiled_lookup_key(name, context) is not missing
+                    for name, index in self._index_records.items()
+                    if isinstance(index, indexing.HashIndex)
+            ):
+                return None
+
+            keys = set()
+            for i, record in self._records.items():
+                for match in compiled_target(record):
+                    keys.add(tuple(indexing.frz(sat.get(k, match)) for k in bound))
+            return keys
+
+        def probe(c):
+            bound = tuple(k for k in variables if sat.has(k, c))
+            values = [sat.get(k, c) for k in bound]
+
+            # constraints and (partially matching) objects can't be hashed
+            if any(callable(v) or isinstance(v, dict) for v in values):
+                return any(True for _ in compiled_subquery([c]))
+
+            state = self._version, tuple(self._index_keys)
+            if bound not in tables or tables[bound][0] != state:
+                tables[bound] = state, build_table(bound, c)
+
+            if tables[bound][1] is None:
+                return any(True for _ in compiled_subquery([c]))
+            else:
+                return tuple(indexing.frz(v) for v in values) in tables[bound][1]
+
+        return probe
+
+    def _is_pattern_match(self, subquery):
+        # matches the idiom EXISTS (WITH value, patterns AS pattern[] WHERE value.match(pattern))
+        if len(subquery.children) != 2 or [child.data for child in subquery.children] != ['with_clause', 'where_clause']:
+            return False
+
+        with_pairs = sorted(subquery.children[0].children, key=lambda pair: pair.data, reverse=True)
+        if [pair.data for pair in with_pairs] != ['with_shorthand_pair', 'with_full_pair']:
+            return False
+
+        value, (patterns, unwind) = with_pairs[0].children[0], with_pairs[1].children
+        condition = subquery.children[1].children[0]
+        return (
+            value.data == 'source_variable'
+            and patterns.data == 'source_variable'
+            and unwind.data == 'target_unwind'
+            and unwind.children[0].data == 'target_variable'
+            and str(unwind.children[0].children[0]) != str(value.children[0])
+            and condition.data == 'source_method_call'
+            and condition.children[0] == value
+            and condition.children[1] == 'match'
+            and len(condition.children[2].children) == 1
+            and condition.children[2].children[0] == Tree('source_variable', unwind.children[0].children)
+        )
+
+    def _compile_pattern_match(self, subquery, compiled_subquery):
+        # instead of running one regular expression per pattern, we test the value against all of them at once
+        with_pairs = sorted(subquery.children[0].children, key=lambda pair: pair.data, reverse=True)
+        compiled_value = self._compile_source(with_pairs[0].children[0])
+        compiled_patterns = self._compile_source(with_pairs[1].children[0])
+
+        def probe(c):
+            value = compiled_value(c)
+            pattern_list = compiled_patterns(c)
+            if not isinstance(pattern_list, list) or not all(isinstance(p, str) for p in pattern_list):
+                return any(True for _ in compiled_subquery([c]))
+            return self._pattern_set(pattern_list).matches(value) if len(pattern_list) > 0 else False
+
+        return probe
+
+    def _pattern_set(self, pattern_list):
+        if not isinstance(pattern_list, list) or not all(isinstance(p, str) for p in pattern_list):
+            raise Exception(f'MATCHES ANY needs an array of patterns, got {pattern_list!r}')
+
+        key = tuple(pattern_list)
+        if key in self._pattern_sets:
+            self._pattern_sets.move_to_end(key)
+        else:
+            self._pattern_sets[key] = patterns.PatternSet(pattern_list)
+            if len(self._pattern_sets) > self._pattern_cache_size:
+                self._pattern_sets.popitem(last=False)
+        return self._pattern_sets[key]
+
+    def _regex(self, pattern):
+        # the re module's own cache is cleared when it's full, which happens a lot with large pattern lists
+        if pattern in self._regexes:
+            self._regexes.move_to_end(pattern)
+        else:
+            self._regexes[pattern] = re.compile(pattern)
+            if len(self._regexes) > self._regex_cache_size:
+                self._regexes.popitem(last=False)
+        return self._regexes[pattern]
+
     def _validate(self, format, instance, schema):
         if format == 'JSON':
             try:
@@ -832,91 +1745,3 @@ class Session:
             return True
         else:
             raise Exception(f'Validating format {format} is not supported')
-
-    def _simplify_target(self, expression, context):
-        if expression.data == 'target_object':
-            pairs = [
-                (
-                    Tree('target_full_pair', [
-                        target_pair.children[0],
-                        self._simplify_target(target_pair.children[1], context)
-                    ]) if target_pair.data == 'target_full_pair'
-                    else Tree('target_full_pair', [
-                        target_pair.children[0],
-                        self._simplify_target(Tree('target_variable', target_pair.children), context)
-                    ])
-                )
-                for target_pair in expression.children
-                if target_pair.data in ('target_shorthand_pair', 'target_full_pair')
-            ]
-            rest = next((
-                self._simplify_target(child.children[0], context)
-                for child in expression.children
-                if child.data == 'target_rest_expression'
-            ), None)
-            children = pairs
-            if rest is not None:
-                children.append(rest)
-            return Tree('target_object', children)
-        elif expression.data == 'target_variable':
-            key = self._compile_identifier(expression)
-            if sat.has(key, context):
-                return Tree('target_constant', [json.dumps(sat.get(key, context))])
-            else:
-                return expression
-        elif expression.data == 'target_key':
-            i = int(expression.children[0])
-            if '$keys' in context and len(context['$keys']) > i:
-                return Tree('target_constant', [json.dumps(context['$keys'][i])])
-            else:
-                return expression
-        else:
-            return expression
-
-    def _calc_lookup_key(self, target_expression, key_expression):
-        if target_expression.data == 'target_object' and key_expression.data == 'target_object':
-            pairs = {
-                str(target_pair.children[0]): (
-                    target_pair.children[1] if target_pair.data == 'target_full_pair'
-                    else Tree('target_variable', target_pair.children)
-                )
-                for target_pair in target_expression.children
-                if target_pair.data in ('target_shorthand_pair', 'target_full_pair')
-            }
-            rest = next((
-                child.children[0]
-                for child in target_expression.children
-                if child.data == 'target_rest_expression'
-            ), None)
-
-            lookup_key = {}
-            for child in key_expression.children:
-                if child.data == 'target_shorthand_pair':
-                    key = str(child.children[0])
-                    if key not in pairs:
-                        return None
-                    elif pairs[key].data != 'target_constant':
-                        return None
-                    else:
-                        lookup_key = sat.cmb(
-                            lookup_key,
-                            sat.ctx(key, json.loads(pairs[key].children[0]))
-                        )
-                elif child.data == 'target_full_pair':
-                    key = str(child.children[0])
-                    if key not in pairs:
-                        return None
-                    else:
-                        lookup_key = sat.cmb(
-                            lookup_key,
-                            self._calc_lookup_key(pairs[key], child.children[1])
-                        )
-                elif child.data == 'target_rest_expression':
-                    if rest is None:
-                        return None
-
-            return lookup_key
-        elif target_expression.data == 'target_constant' and key_expression.data == 'target_variable':
-            return sat.ctx(str(key_expression.children[0]), json.loads(target_expression.children[0]))
-        else:
-            return None
@@ -0,0 +1,81 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Writers:
+    """
+    Buffered writers for a number of text files, which are each truncated once and written to in batches of lines on a
+    pool of threads, keeping the lines of each file in order, with at most max_open files open at a time
+    >>> import os, tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> with Writers(2, batch_size=2, max_open=1) as writers:
+    ...     for j in range(5):
+    ...         writers.write(os.path.join(d, f'{j % 2}.txt'), f'{j}\\n')
+    >>> open(os.path.join(d, '0.txt')).read(), open(os.path.join(d, '1.txt')).read()
+    ('0\\n2\\n4\\n', '1\\n3\\n')
+    """
+    def __init__(self, workers, batch_size=4096, max_open=256):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._batch_size = batch_size
+        self._max_open = max_open
+        # the file object (None while it is closed), the lines that haven't been written yet and the last batch that is
+        # being written, by path
+        self._files = {}
+        # the paths of the open files, least recently used first
+        self._open = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def paths(self):
+        return list(self._files)
+
+    def write(self, path, line):
+        if path not in self._files:
+            self._files[path] = [None, [], None]
+
+        file = self._files[path]
+        file[1].append(line)
+        if len(file[1]) >= self._batch_size:
+            self._flush(path)
+
+    def _flush(self, path):
+        file = self._files[path]
+        fp, lines, batch = file
+        # wait for the previous batch, so that the batches of a file are written in order
+        if batch is not None:
+            batch.result()
+        if fp is None:
+            if len(self._open) >= self._max_open:
+                self._close(next(iter(self._open)))
+            # a file is only truncated before its first batch, and appended to when it is reopened
+            fp = file[0] = open(path, 'w' if batch is None else 'a', encoding='UTF-8')
+        self._open[path] = None
+        self._open.move_to_end(path)
+        file[1] = []
+        file[2] = self._executor.submit(fp.write, ''.join(lines))
+
+    def _close(self, path):
+        file = self._files[path]
+        del self._open[path]
+        try:
+            file[2].result()
+        finally:
+            file[0].close()
+            file[0] = None
+
+    def close(self):
+        try:
+            for path, file in self._files.items():
+                if len(file[1]) > 0:
+                    self._flush(path)
+            for file in self._files.values():
+                if file[2] is not None:
+                    file[2].result()
+        finally:
+            for path in list(self._open):
+                self._files[path][0].close()
+            self._executor.shutdown()
@@ -0,0 +1,71 @@
+import collections
+import itertools
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+# the functions of the current fork_map() call, which forked workers inherit, because closures can't be pickled
+_tasks = []
+_worker = False
+
+
+def available():
+    """
+    Checks if worker processes can be forked, which is what lets them share the memory of this process
+    """
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def is_worker():
+    """
+    Checks if this is a worker process, which shouldn't fork workers of its own
+    """
+    return _worker
+
+
+def _run(j):
+    global _worker
+    _worker = True
+    return list(_tasks[j]())
+
+
+def fork_map(tasks, workers):
+    """
+    Runs functions (that return iterables) in forked worker processes and yields their results as lists, in order
+    All workers are forked before this returns, so they see a snapshot of the memory of this process at the time of
+    the call, even if the results are consumed later
+    >>> results = fork_map([lambda: range(3), lambda: 'ab'], 2)
+    >>> list(results)
+    [[0, 1, 2], ['a', 'b']]
+    """
+    global _tasks
+    _tasks = list(tasks)
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    futures = [executor.submit(_run, j) for j in range(len(_tasks))]
+    executor.shutdown(wait=False)
+
+    return (future.result() for future in futures)
+
+
+def thread_map(function, items, workers, ordered=True):
+    """
+    Runs a function on items in a pool of threads and yields the results in the order of the items, or as soon as
+    they're done if the order doesn't matter, with at most twice as many items in flight as there are workers
+    >>> list(thread_map(lambda x: x * 2, range(5), 2))
+    [0, 2, 4, 6, 8]
+    >>> sorted(thread_map(lambda x: x * 2, range(5), 2, ordered=False))
+    [0, 2, 4, 6, 8]
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque(executor.submit(function, item) for item in itertools.islice(items, 2 * workers))
+        while len(pending) > 0:
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+                pending.remove(future)
+
+            result = future.result()
+            pending.extend(executor.submit(function, item) for item in itertools.islice(items, 1))
+            yield result
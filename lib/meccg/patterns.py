@@ -0,0 +1,106 @@
+import re
+
+from meccg import indexing
+
+
+def alt(pattern):
+    """
+    Checks if a regular expression has an alternation outside of any group, like ^a|b$
+    >>> alt('^Orcs|Trolls$')
+    True
+    >>> alt('^(Orcs|Trolls)$')
+    False
+    >>> alt('^[|]\\\\|$')
+    False
+    """
+    depth = 0
+    j = 0
+    while j < len(pattern):
+        c = pattern[j]
+        if c == '\\':
+            j += 1
+        elif c == '[':
+            j += 1
+            if j < len(pattern) and pattern[j] == ']':
+                j += 1
+            while j < len(pattern) and pattern[j] != ']':
+                j += 2 if pattern[j] == '\\' else 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return True
+        j += 1
+
+    return False
+
+
+class PatternSet:
+    """
+    A list of regular expressions that is compiled once, so that a string can be tested against all of them at once
+    Patterns that start with ^ are grouped by the first character of their literal prefix, and each group is compiled
+    into a single alternation with a named group per pattern
+    >>> ps = PatternSet(['^Orcs\\\\.$', '^Trolls\\\\.$', '^.* strikes\\\\.$', '^(One|Two) strikes?\\\\.$', 'Wolf|Warg'])
+    >>> ps.search('Trolls.')
+    1
+    >>> ps.search('Five strikes.')
+    2
+    >>> ps.search('One strike.')
+    3
+    >>> ps.search('Wargs.')
+    4
+    >>> ps.search('Orcs. Trolls.') is None
+    True
+    >>> PatternSet(['(a)\\\\1', 'b']).search('xaa')
+    0
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+
+        anchored = {}
+        unanchored = []
+        singles = []
+        for i, p in enumerate(self.patterns):
+            if re.search(r'\\[1-9]|\(\?P=', p):
+                # backreferences refer to group numbers, which change when patterns are combined
+                singles.append(i)
+            elif p.startswith('^') and not alt(p):
+                anchored.setdefault(indexing.lit(p)[:1], []).append(i)
+            else:
+                unanchored.append(i)
+
+        self._anchored = {prefix: self._compile(ids, True) for prefix, ids in anchored.items()}
+        self._unanchored = self._compile(unanchored, False) if len(unanchored) > 0 else []
+        self._singles = [(i, re.compile(self.patterns[i]).search) for i in singles]
+
+    def _compile(self, ids, anchored):
+        if anchored:
+            pattern = '|'.join(f'(?P<p{i}>{self.patterns[i][1:]})' for i in ids)
+        else:
+            pattern = '|'.join(f'(?P<p{i}>{self.patterns[i]})' for i in ids)
+
+        try:
+            compiled = re.compile(pattern)
+            return [(None, compiled.match if anchored else compiled.search)]
+        except re.error:
+            # patterns with global flags, for example, can't be combined
+            return [(i, re.compile(self.patterns[i]).search) for i in ids]
+
+    def search(self, s):
+        """
+        Returns the position of a pattern that matches the string, or None if none of them do
+        """
+        if not isinstance(s, str):
+            raise TypeError(f'expected string, got {type(s).__name__}')
+
+        candidates = self._anchored.get('', []) + self._anchored.get(s[:1], []) if s != '' else self._anchored.get('', [])
+        for i, search in candidates + self._unanchored + self._singles:
+            match = search(s)
+            if match is not None:
+                return int(match.lastgroup[1:]) if i is None else i
+
+        return None
+
+    def matches(self, s):
+        return self.search(s) is not None
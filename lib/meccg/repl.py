@@ -1,4 +1,5 @@
 import json
+import os
 import re
 import traceback
 
@@ -13,10 +14,16 @@ def next_statement(commands):
         return None, commands
 
 
-def repl(initialization_query=None):
-    session = Session()
-    if initialization_query is not None:
-        session.query(initialization_query)
+def repl(initialization_query=None, database_path=None):
+    # with a database file, the initialization query only runs once, and later sessions open the saved database
+    if database_path is not None and os.path.exists(database_path):
+        session = Session.open(database_path)
+    else:
+        session = Session()
+        if initialization_query is not None:
+            session.query(initialization_query)
+        if database_path is not None:
+            session.save(database_path)
     commands = ""
     while True:
         try:
@@ -35,3 +42,5 @@ def repl(initialization_query=None):
                         print(json.dumps(row, indent='  '))
             except Exception:
                 traceback.print_exc()
+
+    session.close()
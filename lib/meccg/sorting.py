@@ -0,0 +1,69 @@
+import heapq
+import itertools
+import pickle
+import tempfile
+
+
+def spill(run, chunk_size=1024):
+    """
+    Writes a sorted run to a temporary file and returns a generator that reads it back
+    >>> list(spill([(1, 0, 'Ori'), (2, 1, 'Dori')], chunk_size=1))
+    [(1, 0, 'Ori'), (2, 1, 'Dori')]
+    """
+    fp = tempfile.TemporaryFile()
+    try:
+        for j in range(0, len(run), chunk_size):
+            pickle.dump(run[j:j + chunk_size], fp, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        fp.close()
+        raise
+    fp.seek(0)
+
+    def read():
+        with fp:
+            while True:
+                try:
+                    yield from pickle.load(fp)
+                except EOFError:
+                    break
+
+    return read()
+
+
+def sort(items, key, limit=None, budget=None):
+    """
+    Sorts items by a key that is computed once per item, and returns an iterator over the sorted items
+    With a limit, only the first items are kept, in a heap, and with a budget, sorted runs of that many items are
+    spilled to temporary files and merged at the end; the sort is stable either way
+    >>> list(sort(['Ori', 'Dori', 'Nori', 'Bifur'], key=len))
+    ['Ori', 'Dori', 'Nori', 'Bifur']
+    >>> list(sort(range(10), key=lambda x: -x, limit=3))
+    [9, 8, 7]
+    >>> list(sort([(x % 3, x) for x in range(10)], key=lambda x: x[0], budget=4))
+    [(0, 0), (0, 3), (0, 6), (0, 9), (1, 1), (1, 4), (1, 7), (2, 2), (2, 5), (2, 8)]
+    """
+    # the position of each item breaks ties, so that items themselves are never compared
+    counter = itertools.count()
+    entries = ((key(item), next(counter), item) for item in items)
+
+    if limit is not None:
+        return iter([item for _, _, item in heapq.nsmallest(limit, entries)])
+
+    runs = []
+    run = []
+    for entry in entries:
+        run.append(entry)
+        if budget is not None and len(run) >= budget:
+            run.sort()
+            try:
+                runs.append(spill(run))
+            except (pickle.PicklingError, AttributeError, TypeError):
+                # contexts with constraints (functions) can't be pickled, so they have to stay in memory
+                runs.append(iter(run))
+            run = []
+
+    run.sort()
+    if len(runs) == 0:
+        return iter([item for _, _, item in run])
+    else:
+        return (item for _, _, item in heapq.merge(*runs, iter(run)))
@@ -0,0 +1,166 @@
+import json
+import mmap
+import os
+from collections.abc import MutableMapping
+
+from lark import Tree, Token
+
+# a database file starts with this line, followed by one line of JSON per record, a line of JSON with everything else
+# (the header) and a line with the offset of the header
+MAGIC = b'MEDEA 1\n'
+TRAILER = 21
+
+
+def dump_tree(node):
+    """
+    Turns a parse tree into JSON
+    >>> dump_tree(Tree('target_object', [Tree('target_shorthand_pair', [Token('CNAME', 'name')])]))
+    {'data': 'target_object', 'children': [{'data': 'target_shorthand_pair', 'children': [['CNAME', 'name']]}]}
+    >>> load_tree(dump_tree(Tree('target_variable', [Token('CNAME', 'name')])))
+    Tree('target_variable', [Token('CNAME', 'name')])
+    """
+    if isinstance(node, Tree):
+        return {'data': str(node.data), 'children': [dump_tree(child) for child in node.children]}
+    else:
+        return [node.type, str(node)]
+
+
+def load_tree(data):
+    if isinstance(data, dict):
+        return Tree(data['data'], [load_tree(child) for child in data['children']])
+    else:
+        return Token(*data)
+
+
+class LazyStore(MutableMapping):
+    """
+    A dictionary of records by id, where records that were read from a database file are only decoded when used
+    >>> store = LazyStore(b'{"name": "Ori"}\\n{"name": "Dori"}\\n', [[3, 0, 15], [5, 16, 32]])
+    >>> store[7] = {'name': 'Nori'}
+    >>> store.dump(5), store.dump(7)
+    (b'{"name": "Dori"}', b'{"name": "Nori"}')
+    >>> list(store.items())
+    [(3, {'name': 'Ori'}), (5, {'name': 'Dori'}), (7, {'name': 'Nori'})]
+    """
+    def __init__(self, buffer=None, offsets=(), fp=None):
+        # the file is kept open with its map, until the store is closed or mapped to another file
+        self._fp = fp
+        self._buffer = buffer
+        # records that haven't been decoded yet are kept as their (start, end) offsets in the buffer
+        self._items = {i: (start, end) for i, start, end in offsets}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, i):
+        return i in self._items
+
+    def __getitem__(self, i):
+        record = self._items[i]
+        if isinstance(record, tuple):
+            record = self._items[i] = json.loads(self._buffer[record[0]:record[1]])
+        return record
+
+    def __setitem__(self, i, record):
+        self._items[i] = record
+
+    def __delitem__(self, i):
+        del self._items[i]
+
+    def close(self):
+        """
+        Closes the file of the store, after which the records that haven't been decoded yet can't be used
+        """
+        if self._fp is not None:
+            self._buffer.close()
+            self._fp.close()
+            self._fp = None
+            self._buffer = None
+
+    def map(self, path, offsets):
+        """
+        Maps the store to a file with the same records, where the records that haven't been decoded yet are read from
+        """
+        fp, buffer = open_map(path)
+        self.close()
+        self._fp = fp
+        self._buffer = buffer
+        for i, start, end in offsets:
+            if isinstance(self._items[i], tuple):
+                self._items[i] = (start, end)
+
+    def dump(self, i):
+        """
+        Encodes a record as JSON, without decoding it if it hasn't been yet
+        """
+        record = self._items[i]
+        if isinstance(record, tuple):
+            return bytes(self._buffer[record[0]:record[1]])
+        else:
+            return json.dumps(record, ensure_ascii=False).encode('utf-8')
+
+
+def write(path, records, header):
+    # write to a temporary file first, so that the old file stays intact (and readable for a store mapping it)
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as fp:
+        fp.write(MAGIC)
+        offsets = []
+        for i in records:
+            data = records.dump(i) if isinstance(records, LazyStore) else \
+                json.dumps(records[i], ensure_ascii=False).encode('utf-8')
+            start = fp.tell()
+            fp.write(data + b'\n')
+            offsets.append([i, start, start + len(data)])
+
+        header_offset = fp.tell()
+        fp.write(json.dumps({**header, 'records': offsets}, ensure_ascii=False).encode('utf-8') + b'\n')
+        fp.write(b'%020d\n' % header_offset)
+
+    if not isinstance(records, LazyStore):
+        os.replace(temp_path, path)
+        return
+
+    # a file can't be replaced while it's mapped (on Windows), so the store is closed and mapped to the new file, or
+    # to the temporary file if the old one can't be replaced
+    records.close()
+    try:
+        os.replace(temp_path, path)
+    except Exception:
+        records.map(temp_path, offsets)
+        raise
+    records.map(path, offsets)
+
+
+def open_map(path):
+    fp = open(path, 'rb')
+    try:
+        if os.fstat(fp.fileno()).st_size < len(MAGIC) + TRAILER:
+            raise Exception(f'File {path} is not a medea database')
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+        fp.close()
+        raise
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        buffer.close()
+        fp.close()
+        raise Exception(f'File {path} is not a medea database')
+
+    return fp, buffer
+
+
+def read(path):
+    fp, buffer = open_map(path)
+    try:
+        header_offset = int(buffer[-TRAILER:])
+        header = json.loads(buffer[header_offset:-TRAILER])
+    except ValueError:
+        buffer.close()
+        fp.close()
+        raise Exception(f'File {path} is a truncated medea database')
+
+    return header, LazyStore(buffer, header.pop('records'), fp)
@@ -0,0 +1,329 @@
+import os
+
+import pytest
+
+from meccg import indexing, parallel
+from meccg.medea import Session
+
+CARDS = [
+    {'set': 'The Wizards', 'name': 'Ori', 'mp': 1, 'class': 'Character', 'text': ['Orcs. Five strikes.']},
+    {'set': 'The Wizards', 'name': 'Ori 1', 'mp': 1.0},
+    {'set': 'The Wizards', 'name': 'Orion', 'mp': 3, 'text': ['Playable on Orcs.', 'Orcs. Two strikes.']},
+    {'set': 'The Wizards'},
+    {'set': 'The Dragons', 'name': 'Gandalf', 'mp': 2, 'text': ['Orcs. Two strikes.']},
+    {'set': 'The Dragons', 'name': 'Dori', 'mp': None},
+    {'class': 'Hazard', 'name': 'Glorfindel', 'text': ['Wolves.']},
+    {'set': 'The Wizards', 'name': 'Bifur', 'mp': 1},
+    {'set': 'The Dragons', 'name': 'Nori', 'mp': True},
+    'settings',
+    5,
+    ['set'],
+]
+
+# every plan has to give the same results as a plain scan of the records
+PLANS = [
+    ({}, 'CREATE INDEX i ON {set, name};'),
+    ({}, 'CREATE INDEX i ON {name};'),
+    ({}, 'CREATE INDEX i ON {set, name} USING SORTED;'),
+    ({}, 'CREATE INDEX i ON {name} USING SORTED;'),
+    ({}, 'CREATE INDEX i ON {mp} USING SORTED;'),
+    ({}, 'CREATE TEXT INDEX t ON {class, text};'),
+    ({}, 'CREATE INDEX i ON {set, name}; CREATE INDEX j ON {set} USING SORTED;'),
+    ({'storage': 'columnar'}, None),
+    ({'storage': 'columnar'}, 'CREATE INDEX i ON {set, name} USING SORTED;'),
+    ({'workers': 2, 'partition_size': 2}, None),
+]
+
+QUERIES = [
+    ('MATCH {set: "The Wizards", ...rest} RETURN rest;', {}),
+    ('MATCH {set: "The Wizards", name} RETURN name;', {}),
+    ('MATCH {set, name} WHERE name >= "D" WHERE name < "O" RETURN name;', {}),
+    ('MATCH {name} WHERE name == "Ori" RETURN name;', {}),
+    ('MATCH {mp} WHERE mp == 1 RETURN mp;', {}),
+    ('MATCH {mp: 1, name} RETURN name;', {}),
+    ('MATCH {mp} WHERE mp >= 1 RETURN mp;', {}),
+]
+
+
+def session(options, plan):
+    s = Session(**options)
+    s.query('WITH $cards AS card[] CREATE card;', cards=CARDS)
+    if plan is not None:
+        s.query(plan)
+    return s
+
+
+def run(s, query, parameters):
+    result = s.query(query, **parameters)
+    return None if result is None else list(result)
+
+
+def assert_plans(query, **parameters):
+    expected = run(session({}, None), query, parameters)
+    for options, plan in PLANS:
+        if 'workers' not in options or parallel.available():
+            assert run(session(options, plan), query, parameters) == expected, (options, plan)
+
+
+@pytest.mark.parametrize('query, parameters', QUERIES)
+@pytest.mark.parametrize('options, plan', PLANS)
+def test_plans(options, plan, query, parameters):
+    if 'workers' in options and not parallel.available():
+        pytest.skip('worker processes need fork')
+
+    assert run(session(options, plan), query, parameters) == run(session({}, None), query, parameters)
+
+
+@pytest.mark.parametrize('options, plan', PLANS)
+def test_writes(options, plan):
+    queries = [
+        'MERGE {mp: 4} INTO {set: "The Dragons", name: "Dori"};',
+        'MATCH {set: "The Wizards", name} MERGE {seen: "yes"} INTO {set: "The Wizards", name};',
+        'DELETE {name: `Ori`};',
+        'DELETE {mp: 1};',
+        'MATCH {} AS card RETURN card;',
+    ]
+    s = session(options, plan)
+    t = session({}, None)
+    for query in queries:
+        assert run(s, query, {}) == run(t, query, {})
+
+
+def test_index_selection(monkeypatch):
+    # the range of a broad sorted index is only counted, when a hash index has fewer candidates
+    s = session({}, 'CREATE INDEX i ON {set, name}; CREATE INDEX j ON {set} USING SORTED;')
+    monkeypatch.setattr(indexing.SortedIndex, 'scan', lambda *args: pytest.fail('scanned the sorted index'))
+    assert run(s, 'MATCH {set: "The Wizards", name: "Ori", mp} RETURN mp;', {}) == [1]
+
+
+def test_text_index(monkeypatch):
+    assert_plans('MATCH {text: line[]} WHERE line.includes("Orcs") RETURN line;')
+    assert_plans('MATCH {text: line[]} WHERE line.match("^Orcs\\\\. ") RETURN line;')
+    # the attributes of a text index are searched on their own
+    s = session({}, 'CREATE TEXT INDEX t ON {class, text};')
+    monkeypatch.setattr(Session, '_scan_records', lambda *args: pytest.fail('scanned the records'))
+    query = 'MATCH {class, name} WHERE class.includes("Haz") RETURN name;'
+    assert run(s, query, {}) == ['Glorfindel']
+
+
+def test_parameters():
+    assert_plans('MATCH {set: $set, name} RETURN name;', set='The Dragons')
+    assert_plans('MATCH {name} WHERE name == $name RETURN name;', name='Ori')
+
+    # lazy results keep the parameters of their own call
+    s = session({}, None)
+    query = 'MATCH {set: $set, name} RETURN name;'
+    dragons = s.query(query, set='The Dragons')
+    wizards = s.query(query, set='The Wizards')
+    assert list(dragons) == ['Gandalf', 'Dori', 'Nori']
+    assert list(wizards) == ['Ori', 'Ori 1', 'Orion', 'Bifur']
+
+
+def test_joins():
+    assert_plans('MATCH {set, name} MATCH {set, mp} RETURN {name, mp};')
+    assert_plans('WITH ["The Dragons", "The Wizards"] AS set[] MATCH {set, name} RETURN name;')
+
+    # records that aren't objects never match a pattern with attributes
+    s = Session()
+    s.query('WITH $records AS record[] CREATE record;', records=['settings', 5, ['set'], {'set': 'a', 'name': 'x'}])
+    assert run(s, 'WITH ["a", "b"] AS s[] MATCH {set: s, name} RETURN name;', {}) == ['x']
+
+
+def test_semi_joins():
+    assert_plans('MATCH {set, name} WHERE NOT EXISTS (MATCH {set, mp: 2}) RETURN name;')
+    assert_plans('MATCH {set, name} WHERE EXISTS (MATCH {set, mp: 3}) RETURN name;')
+    assert_plans('MATCH {name} WHERE EXISTS (MATCH {class, name}) RETURN name;')
+
+
+def test_lookups(monkeypatch):
+    # templates match every string that starts with them
+    assert run(session({}, None), 'MATCH {name: `Ori`} AS card RETURN card.name;', {}) == ['Ori', 'Ori 1', 'Orion']
+    assert_plans('MATCH {name: `Ori`, ...rest} RETURN rest;')
+    assert_plans('MATCH {set: "The Wizards", name: `Ori`} AS card RETURN card;')
+    assert_plans('MATCH {name: `Ori`} MATCH {name: `Ori`, mp} RETURN mp;')
+
+    # an alias doesn't keep the pattern it wraps from using an index
+    s = session({}, 'CREATE INDEX i ON {set, name};')
+    monkeypatch.setattr(Session, '_scan_records', lambda *args: pytest.fail('scanned the records'))
+    assert run(s, 'MATCH {set: "The Wizards", name: "Ori"} AS card RETURN card.mp;', {}) == [1]
+
+
+def test_matches_any():
+    assert_plans('MATCH {name} WHERE name MATCHES ANY $patterns RETURN name;', patterns=['^Or', 'i$'])
+    s = session({}, None)
+    query = 'MATCH {name} WHERE name MATCHES ANY $patterns RETURN name;'
+    assert run(s, query, {'patterns': ['^G', 'ur$']}) == ['Gandalf', 'Glorfindel', 'Bifur']
+    assert run(s, query, {'patterns': []}) == []
+    with pytest.raises(Exception):
+        run(s, query, {'patterns': 'Ori'})
+
+
+def test_union():
+    # read-only branches run in worker processes, but keep their order
+    assert_plans('MATCH {set, name} AS card RETURN card.name UNION MATCH {class, name} RETURN name;')
+    assert_plans(
+        'MATCH {mp: 2, name} RETURN name UNION MATCH {class, name} RETURN name UNION MATCH {mp: 3, name} RETURN name;'
+    )
+
+
+def test_partitions(monkeypatch):
+    if not parallel.available():
+        pytest.skip('worker processes need fork')
+
+    s = session({'workers': 2, 'partition_size': 2}, 'CREATE INDEX i ON {set, name};')
+    forks = []
+    fork_map = parallel.fork_map
+    monkeypatch.setattr(parallel, 'fork_map', lambda tasks, workers: forks.append(workers) or fork_map(tasks, workers))
+
+    # a MATCH with fewer candidates than two partitions doesn't fork any workers
+    assert run(s, 'MATCH {set: "The Wizards", name: "Ori", mp} RETURN mp;', {}) == [1]
+    assert forks == []
+    assert run(s, 'MATCH {set, name} WHERE set == "The Wizards" RETURN name;', {}) == [
+        'Ori', 'Ori 1', 'Orion', 'Bifur',
+    ]
+    assert forks == [2]
+
+
+def test_order_by():
+    assert_plans('MATCH {name} ORDER BY name RETURN name;')
+    # values of different types are in collation order, and equal keys keep their order, also when runs are spilled
+    for budget in (1000000, 2):
+        s = session({'sort_budget': budget}, None)
+        assert run(s, 'MATCH {name, mp} ORDER BY mp RETURN name;', {}) == [
+            'Dori', 'Nori', 'Ori', 'Ori 1', 'Bifur', 'Gandalf', 'Orion',
+        ]
+
+
+def test_skip_limit():
+    assert_plans('MATCH {name} ORDER BY name SKIP 1 LIMIT 2 RETURN name;')
+    assert_plans('MATCH {name} SKIP 2 LIMIT 3 RETURN name;')
+    assert run(session({}, None), 'MATCH {name} ORDER BY name SKIP 1 LIMIT 2 RETURN name;', {}) == ['Dori', 'Gandalf']
+    # the contexts after the limit are never computed
+    query = 'WITH $values AS value[] WHERE value.includes("O") LIMIT 1 RETURN value;'
+    assert run(Session(), query, {'values': ['Ori', 5]}) == ['Ori']
+
+
+def test_aggregates():
+    query = 'MATCH {set, mp} WITH set, COUNT(mp) AS n, MIN(mp) AS lo, MAX(mp) AS hi RETURN {set, n, lo, hi};'
+    assert_plans(query)
+    # null values aren't counted, and MIN and MAX compare values like ORDER BY does
+    s = session({}, None)
+    assert run(s, query, {}) == [
+        {'set': 'The Wizards', 'n': 4, 'lo': 1, 'hi': 3}, {'set': 'The Dragons', 'n': 2, 'lo': True, 'hi': 2},
+    ]
+    assert run(s, 'MATCH {set, mp} WITH set, SUM(mp) AS total RETURN {set, total};', {}) == [
+        {'set': 'The Wizards', 'total': 6.0}, {'set': 'The Dragons', 'total': 3},
+    ]
+    assert run(s, 'MATCH {set, mp} WITH set, COLLECT(mp) AS mps RETURN {set, mps};', {}) == [
+        {'set': 'The Wizards', 'mps': [1, 1.0, 3, 1]}, {'set': 'The Dragons', 'mps': [2, None, True]},
+    ]
+
+
+def test_collect_distinct():
+    assert_plans('MATCH {set, mp} WITH set, COLLECT(DISTINCT mp) AS mps RETURN {set, mps};')
+    # the values are told apart like RETURN DISTINCT does, so 1, true and 1.0 are all kept
+    values = [1, True, 1.0, 1, {'a': 1, 'b': 2}, {'b': 2, 'a': 1}]
+    for options in ({}, {'distinct_fingerprints': True}):
+        s = Session(**options)
+        query = 'WITH $values AS value[] WITH COLLECT(DISTINCT value) AS values RETURN values;'
+        result = run(s, query, {'values': values})
+        assert result == [run(s, 'WITH $values AS value[] RETURN DISTINCT value;', {'values': values})]
+        assert result == [[1, True, 1.0, {'a': 1, 'b': 2}]]
+
+
+def test_results():
+    s = session({}, None)
+    assert run(s, 'MATCH {set: "The Wizards", ...rest} RETURN rest;', {})[3] == {}
+
+
+def test_distinct():
+    assert_plans('MATCH {mp} RETURN DISTINCT mp;')
+    assert_plans('MATCH {set, name} WITH DISTINCT set RETURN set;')
+    # 1 and 1.0 are different values, like in JSON
+    assert run(session({}, None), 'MATCH {mp} RETURN DISTINCT mp;', {}) == [1, 1.0, 3, 2, None, True]
+    values = [{'a': 1, 'b': [1]}, {'b': [1], 'a': 1}, {'a': True, 'b': [1]}, {'a': 1.0, 'b': [1]}]
+    for options in ({}, {'distinct_fingerprints': True}):
+        s = Session(**options)
+        result = run(s, 'WITH $values AS value[] RETURN DISTINCT value;', {'values': values})
+        assert result == [values[0], values[2], values[3]]
+        result = run(s, 'WITH $values AS value[] WITH DISTINCT value RETURN value;', {'values': values})
+        assert result == [values[0], values[2], values[3]]
+
+
+def test_save_open(tmp_path):
+    path = str(tmp_path / 'cards.medea')
+    s = session({}, 'CREATE INDEX i ON {set, name} USING SORTED;')
+    s.query('CREATE TEXT INDEX t ON {class, text};')
+    s.save(path)
+
+    t = Session.open(path)
+    for query, parameters in QUERIES:
+        assert run(t, query, parameters) == run(s, query, parameters)
+
+    # saving over the file the session reads its records from maps the session to the new file
+    t.query('CREATE {set: "The Balrog", name: "Balrog"};')
+    t.save(path)
+    assert run(t, 'MATCH {} AS card RETURN card;', {}) == run(Session.open(path), 'MATCH {} AS card RETURN card;', {})
+    t.close()
+    os.remove(path)
+
+    for content in (b'', b'MEDEA 1\n', b'MEDEA 1\n{"set": "The Wizards"}\n' + b'0' * 30):
+        with open(path, 'wb') as fp:
+            fp.write(content)
+        with pytest.raises(Exception, match='medea database'):
+            Session.open(path)
+
+
+def test_load_jsonl(tmp_path):
+    with open(tmp_path / 'cards.jsonl', 'w') as fp:
+        fp.write('{"name": "Ori"}\n\n{"name": "Dori"}\n')
+    with open(tmp_path / 'broken.jsonl', 'w') as fp:
+        fp.write('[1\n2]\n3, 4\n')
+
+    s = Session()
+    assert run(s, f'LOAD JSONL FROM "{tmp_path}/cards.jsonl" AS {{name}} RETURN name;', {}) == ['Ori', 'Dori']
+    with pytest.raises(ValueError):
+        run(s, f'LOAD JSONL FROM "{tmp_path}/broken.jsonl" AS value RETURN value;', {})
+
+
+def test_load_threads(tmp_path):
+    for j in range(8):
+        with open(tmp_path / f'cards_{j}.jsonl', 'w') as fp:
+            fp.write(''.join(f'{{"file": {j}, "n": {k}}}\n' for k in range(3)))
+
+    # files that are read on threads still give their values in the order of the files
+    query = f'LOAD JSONL FROM `{tmp_path}/cards_` AS {{file, n}} RETURN {{file, n}};'
+    result = run(Session(io_workers=1), query, {})
+    assert run(Session(io_workers=4), query, {}) == result
+    unordered = run(Session(io_workers=4), query.replace('LOAD', 'LOAD UNORDERED'), {})
+    assert sorted(unordered, key=lambda r: (r['file'], r['n'])) == sorted(result, key=lambda r: (r['file'], r['n']))
+
+
+def test_load(tmp_path):
+    for j in range(20):
+        with open(tmp_path / f'cards_{j:02}.jsonl', 'w') as fp:
+            fp.write(''.join(f'{{"file": {j}, "n": {k}}}\n' for k in range(10)))
+
+    # a cache that only holds a few of the files still gives every value, on every thread
+    s = Session(io_workers=4, file_cache_size=3 * os.path.getsize(tmp_path / 'cards_00.jsonl'))
+    query = f'LOAD JSONL FROM `{tmp_path}/cards_` AS {{file, n}} RETURN {{file, n}};'
+    for _ in range(3):
+        result = run(s, query, {})
+        assert sorted((r['file'], r['n']) for r in result) == [(j, k) for j in range(20) for k in range(10)]
+        # and the statement only keeps the files that are still in the cache
+        assert len(s._statement_files) <= 3
+
+
+def test_save_paths(tmp_path):
+    # more paths than there are file descriptors, with the lines of each path apart, so that files are reopened
+    resource = pytest.importorskip('resource')
+    limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (512, limits[1]))
+    try:
+        s = Session(io_workers=4)
+        query = f'WITH $paths AS path[] SAVE TEXT path TO `{tmp_path}/${{path}}.txt`;'
+        run(s, query, {'paths': [f'{j:04}' for j in range(3000)] * 2})
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+    assert len(os.listdir(tmp_path)) == 3000
+    assert all(open(tmp_path / f'{j:04}.txt').read() == f'{j:04}\n' * 2 for j in range(3000))
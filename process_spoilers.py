@@ -1,4 +1,3 @@
-import re
 import time
 
 from meccg.medea import Session
@@ -6,10 +5,6 @@ from meccg.medea import Session
 if __name__ == '__main__':
     start = time.perf_counter()
 
-    # increase regular expression cache size
-    # there are a lot of patterns in var/regex/text.hazard-event.txt, so the default 512 won't suffice
-    re._MAXCACHE = 1024
-
     scripts = [
         'var/process/extract.mql',
         'var/process/transform.mql',